@@ -8,8 +8,12 @@ from flask_sqlalchemy import SQLAlchemy
 
 from nptimelapse import index, api
 # from nptimelapse.model import
-from nptimelapse.cli import init_db, fetch_owners, purge_videos
+from nptimelapse.cli import init_db, upgrade_db, fetch_owners, purge_videos, \
+                            build_snapshots_command, import_game, \
+                            compact_games
+from nptimelapse.benchmark import benchmark
 from nptimelapse.extensions import db, celery
+from nptimelapse.metrics import init_logging
 
 
 def create_app(test_config=None):
@@ -33,6 +37,7 @@ def create_app(test_config=None):
 
     # initialise celery
     init_celery(app)
+    init_logging(app)
 
     # the simplest page
     @app.route('/hello')
@@ -54,8 +59,13 @@ def create_app(test_config=None):
 
     # commandline arguments
     app.cli.add_command(init_db)
+    app.cli.add_command(upgrade_db)
     app.cli.add_command(fetch_owners)
     app.cli.add_command(purge_videos)
+    app.cli.add_command(build_snapshots_command)
+    app.cli.add_command(import_game)
+    app.cli.add_command(compact_games)
+    app.cli.add_command(benchmark)
 
     return app
 
@@ -1,11 +1,60 @@
-from flask import Blueprint, abort
-from flask.json import jsonify
+from flask import Blueprint, abort, current_app, request
+from flask.wrappers import Response
+from sqlalchemy import func
 
-from nptimelapse.model import Game, Star, Owner
+from nptimelapse.extensions import db
+from nptimelapse.history import History
+from nptimelapse.index import draw_options
+from nptimelapse.map_maker import Map
+from nptimelapse.model import Game, Star, Video
+from nptimelapse.video_cache import job_status
+
+from collections import OrderedDict
+import gzip
+import hashlib
+import struct
+from threading import Lock
+import numpy as np
 
 
 bp = Blueprint('api', __name__, url_prefix='/api')
 
+# Serialized responses by game id, least recently used first
+CACHE_SIZE = 32
+cache = OrderedDict()
+cache_lock = Lock()
+
+
+# Response with a cached body, handling conditional requests and gzip. The
+# lock only guards the cache, bodies are made outside of it.
+def cached_response(key, version, make_body, mimetype):
+    with cache_lock:
+        entry = cache.get(key)
+        if entry is not None and entry['version'] == version:
+            cache.move_to_end(key)
+    if entry is None or entry['version'] != version:
+        body = make_body()
+        entry = {'version': version,
+                    'etag': hashlib.md5(body).hexdigest(),
+                    'body': body,
+                    'gzip': gzip.compress(body)}
+        with cache_lock:
+            cache[key] = entry
+            cache.move_to_end(key)
+            while len(cache) > CACHE_SIZE:
+                cache.popitem(last=False)
+
+    if 'gzip' in request.accept_encodings:
+        response = Response(entry['gzip'], mimetype=mimetype)
+        response.content_encoding = 'gzip'
+        response.set_etag(entry['etag'] + '-gzip')
+    else:
+        response = Response(entry['body'], mimetype=mimetype)
+        response.set_etag(entry['etag'])
+    response.vary.add('Accept-Encoding')
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
 
 @bp.route('/game/<int:game_id>')
 def game_info(game_id):
@@ -14,15 +63,95 @@ def game_info(game_id):
     if game is None:
         abort(404)
 
-    # Prepare game data
-    game = {'id': game.id, 'name': game.name, 'close_date': game.close_date, 'stars': {}}
+    # The body only changes when new ticks are recorded or the game closes
+    version = (game.end_tick, game.close_date)
+
+    def make_body():
+        # Prepare game data
+        data = {'id': game.id, 'name': game.name, 'close_date': game.close_date, 'stars': {}}
+
+        # Construct the JSON from the history, which also reads packed games
+        history = History.from_db(game_id)
+        for star_id, x, y in zip(history.star_ids.tolist(), history.star_x.tolist(),
+                                 history.star_y.tolist()):
+            data['stars'][star_id] = {'x': x, 'y': y, 'owners': {}}
+        for tick, star_id, player in zip(history.ticks.tolist(),
+                                         history.star_ids[history.stars].tolist(),
+                                         history.players.tolist()):
+            data['stars'][star_id]['owners'][tick] = player
+        return current_app.json.dumps(data, separators=(',', ':')).encode()
+
+    return cached_response(('game', game_id), version, make_body, 'application/json')
+
+
+# Columnar binary history, see nptimelapse.history for the layout
+@bp.route('/game/<int:game_id>/history')
+def game_history(game_id):
+    game = Game.query.filter(Game.id == game_id).one_or_none()
+    if game is None:
+        abort(404)
+
+    version = (game.end_tick, game.close_date)
+    return cached_response(('history', game_id), version,
+                           lambda: History.from_db(game_id).to_bytes(),
+                           'application/octet-stream')
+
+
+# Binary label map layout, all little endian:
+#   header: magic b'NPTL', format version, rescale, width and height in
+#           percieved pixels, star count, drawn star count, bytes per label,
+#           territory color count
+#   labels: int16[] or int32[] star index of each percieved pixel, rows
+#           first, -1 for borders and empty space
+#   drawn stars: star indices int32[], x int32[], y int32[]
+#   colors: uint8[] RGB territory colors
+LABELS_MAGIC = b'NPTL'
+LABELS_VERSION = 1
+LABELS_HEADER = struct.Struct('<4sHHIIIIHH')
+
+
+# Nearest star of every percieved pixel for a smoothness and border style,
+# stars indexed like in the history. With the history it's all a browser
+# needs to paint any frame in any star style.
+@bp.route('/game/<int:game_id>/labels')
+def game_labels(game_id):
+    stars = db.session.query(func.count(Star.id)).filter(Star.game_id == game_id).scalar()
+    if not stars:
+        abort(404)
+    draw_params, _, border, smoothness = draw_options(request.args)
+    draw_params.pop('star_cols', None)
+
+    def make_body():
+        rows = db.session.query(Star.id, Star.x, Star.y) \
+            .filter(Star.game_id == game_id).order_by(Star.id).all()
+        m = Map(rows, **draw_params)
+        labels = m.labels.astype('<i2' if m.labels.dtype == np.int16 else '<i4')
+        header = LABELS_HEADER.pack(LABELS_MAGIC, LABELS_VERSION, m.rescale,
+                                    m.labels.shape[1], m.labels.shape[0], len(rows),
+                                    len(m.star_drawn), labels.itemsize, len(m.cols))
+        return b''.join([header,
+                         labels.tobytes(),
+                         m.star_drawn.astype('<i4').tobytes(),
+                         m.star_px[1].astype('<i4').tobytes(),
+                         m.star_px[0].astype('<i4').tobytes(),
+                         np.array(m.cols, np.uint8).tobytes()])
+
+    return cached_response(('labels', game_id, smoothness, border != 'none'), stars,
+                           make_body, 'application/octet-stream')
 
-    # Construct the JSON
-    stars = Star.query.filter(Star.game_id == game_id).all()
-    for star in stars:
-        game['stars'][star.id] = {'x': star.x, 'y': star.y, 'owners': {}}
-        owners = Owner.query.filter(Owner.game_id == game_id) \
-            .filter(Owner.star_id == star.id).all()
-        game['stars'][star.id]['owners'] = {owner.tick: owner.player for owner in owners}
 
-    return jsonify(game)
+# State of a timelapse for pages polling its progress, read from the database
+# only
+@bp.route('/timelapse/<string:key>')
+def timelapse_status(key):
+    if Video.query.filter(Video.key == key).one_or_none() is not None:
+        status = {'status': 'READY'}
+    else:
+        job = job_status(key)
+        if job is None:
+            status = {'status': 'NOT_READY'}
+        elif job['phase'] == 'failed':
+            status = {'status': 'FAILED', **job}
+        else:
+            status = {'status': 'IN_PROGRESS', **job}
+    return status, {'Cache-Control': 'no-store'}
@@ -0,0 +1,217 @@
+import click
+from sqlalchemy import insert
+
+from nptimelapse.encoding import DEFAULT_PROFILE, profile_settings, profile_format, \
+                                 video_writer
+from nptimelapse.compaction import pack_game
+from nptimelapse.extensions import db
+from nptimelapse.history import History
+from nptimelapse.map_maker import Map, RESCALE, PIX_PER_CELL
+from nptimelapse.model import Game, Star, Owner, record_owners, record_tick
+from nptimelapse.snapshots import build_snapshots, owners_at
+
+from contextlib import contextmanager
+from io import BytesIO
+from math import cos, sin, pi, sqrt
+import json
+import os.path
+import random
+import resource
+import tempfile
+import time
+
+
+GAME_ID = 1
+FIRST_TICK = 1
+# Map area per star, close to the density of real galaxies
+STAR_AREA = .25
+# Ticks the owner lookups are timed on
+QUERY_TICKS = 50
+# Frames saved as PNG
+PNG_FRAMES = 20
+
+
+# Peak resident memory of the process so far in MiB
+def max_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# Time a stage of count operations into results
+@contextmanager
+def stage(results, name, count=1):
+    start = time.perf_counter()
+    yield
+    seconds = time.perf_counter() - start
+    results[name] = {'seconds': seconds, 'count': count,
+                      'per_op': seconds / max(count, 1), 'max_rss': max_rss()}
+
+
+# Stars spread over a disc and the owner changes of every tick, the first
+# tick giving every star an owner
+def synthetic_game(stars, ticks, churn, players, seed):
+    r = random.Random(seed)
+    radius = sqrt(stars * STAR_AREA / pi)
+    points = []
+    for star_id in range(stars):
+        angle, distance = r.uniform(0, 2 * pi), radius * sqrt(r.random())
+        points.append({'id': star_id, 'game_id': GAME_ID,
+                       'x': distance * cos(angle), 'y': distance * sin(angle)})
+    changes = [[(star_id, r.randrange(-1, players)) for star_id in range(stars)]]
+    for _ in range(1, ticks):
+        changes.append([(star_id, r.randrange(-1, players))
+                        for star_id in r.sample(range(stars), min(churn, stars))])
+    return points, changes
+
+
+# Time every stage of serving a game on a throwaway SQLite database
+def run_benchmark(stars, ticks, churn, players, seed, map_config, encode,
+                  profile=DEFAULT_PROFILE):
+    results = {}
+    with stage(results, 'generate'):
+        points, changes = synthetic_game(stars, ticks, churn, players, seed)
+
+    # Recorded like fetch-owners does, one row per actual change
+    owners = {}
+    rows = []
+    for tick, tick_changes in enumerate(changes, FIRST_TICK):
+        for star_id, player in tick_changes:
+            if owners.get(star_id, -1) != player:
+                owners[star_id] = player
+                rows.append({'tick': tick, 'star_id': star_id,
+                             'game_id': GAME_ID, 'player': player})
+    with stage(results, 'db_insert', len(rows)):
+        game = Game(id=GAME_ID, api_key='', name='Benchmark')
+        db.session.add(game)
+        db.session.flush()
+        db.session.execute(insert(Star), points)
+        record_owners(rows)
+        record_tick(game, FIRST_TICK)
+        record_tick(game, FIRST_TICK + ticks - 1)
+        db.session.commit()
+    with stage(results, 'db_snapshots'):
+        build_snapshots(GAME_ID)
+        db.session.commit()
+    with stage(results, 'db_history'):
+        history = History.from_db(GAME_ID)
+
+    query_ticks = range(FIRST_TICK, FIRST_TICK + ticks, max(1, ticks // QUERY_TICKS))
+    with stage(results, 'db_tick_query', len(query_ticks)):
+        for tick in query_ticks:
+            db.session.query(Owner.star_id, Owner.player) \
+                .filter(Owner.game_id == GAME_ID).filter(Owner.tick == tick).all()
+    with stage(results, 'db_owners_at', len(query_ticks)):
+        for tick in query_ticks:
+            owners_at(GAME_ID, tick)
+    # Closed games are read from their packed history
+    with stage(results, 'db_pack'):
+        packed_bytes = pack_game(GAME_ID)
+        db.session.commit()
+    with stage(results, 'db_unpack'):
+        History.from_db(GAME_ID)
+
+    with stage(results, 'map_init'):
+        m = Map(history.star_points(), **map_config)
+    tick_owners = list(history.tick_owners())
+    with stage(results, 'map_update', len(tick_owners)):
+        for owners in tick_owners:
+            m.update(owners)
+    cells = [(x, y) for x in range(m.grid_size[0] - 1) for y in range(m.grid_size[1] - 1)]
+    with stage(results, 'map_update_cell', len(cells)):
+        for x, y in cells:
+            m.update_cell(x, y)
+    with stage(results, 'map_frame', len(tick_owners)):
+        for _ in tick_owners:
+            m.frame()
+    with stage(results, 'png_save', PNG_FRAMES):
+        for _ in range(PNG_FRAMES):
+            m.image.save(BytesIO(), 'PNG')
+
+    if encode:
+        with tempfile.TemporaryDirectory() as folder:
+            m.set_owners(-1)
+            settings = profile_settings(profile)
+            extension = profile_format(settings)['extension']
+            writer = video_writer(os.path.join(folder, f'benchmark.{extension}'), m, settings)
+            with stage(results, 'encode', len(tick_owners)):
+                for frame in m.frames(tick_owners):
+                    writer.write_frame(frame)
+                writer.close()
+
+    summary = {'render_fps': len(tick_owners) / (results['map_update']['seconds']
+                                                 + results['map_frame']['seconds']),
+               'max_rss': max_rss(),
+               'image_size': list(m.im_size),
+               'owner_rows': len(rows),
+               'packed_bytes': packed_bytes}
+    if encode:
+        summary['encode_fps'] = len(tick_owners) / results['encode']['seconds']
+    return results, summary
+
+
+def print_results(results, summary, baseline=None):
+    click.echo(f'{"stage":<16}{"seconds":>10}{"count":>8}{"ms/op":>10}{"MiB":>8}'
+               + ('  vs baseline' if baseline else ''))
+    for name, result in results.items():
+        line = (f'{name:<16}{result["seconds"]:>10.3f}{result["count"]:>8}'
+                f'{result["per_op"] * 1000:>10.3f}{result["max_rss"]:>8.0f}')
+        if baseline and name in baseline['stages']:
+            line += f'  {result["seconds"] / baseline["stages"][name]["seconds"]:>10.2f}x'
+        click.echo(line)
+    for name, value in summary.items():
+        if isinstance(value, float):
+            value = f'{value:.2f}'
+        click.echo(f'{name}: {value}')
+
+
+# Used to measure the rendering pipeline and database access on a synthetic
+# game. Runs on its own temporary SQLite database, never the configured one.
+@click.command('benchmark')
+@click.option('--stars', default=500, help='Number of stars in the galaxy.')
+@click.option('--ticks', default=200, help='Number of recorded ticks.')
+@click.option('--churn', default=5, help='Owner changes per tick.')
+@click.option('--players', default=8, help='Number of players.')
+@click.option('--seed', default=1, help='Seed of the synthetic game.')
+@click.option('--rescale', default=RESCALE)
+@click.option('--pix-per-cell', default=PIX_PER_CELL)
+@click.option('--border/--no-border', default=False)
+@click.option('--encode/--no-encode', default=True, help='Also time video encoding.')
+@click.option('--profile', default=DEFAULT_PROFILE, help='Encoding profile to time.')
+@click.option('--save', 'save_path', type=click.Path(), help='Save results as a baseline.')
+@click.option('--baseline', type=click.Path(exists=True), help='Compare with a saved baseline.')
+@click.option('--tolerance', default=.1, help='Slowdown against the baseline that fails.')
+def benchmark(stars, ticks, churn, players, seed, rescale, pix_per_cell, border, encode,
+              profile, save_path, baseline, tolerance):
+    from nptimelapse import create_app
+
+    config = {'stars': stars, 'ticks': ticks, 'churn': churn, 'players': players,
+              'seed': seed, 'rescale': rescale, 'pix_per_cell': pix_per_cell,
+              'border': border, 'profile': profile}
+    map_config = {'rescale': rescale, 'pix_per_cell': pix_per_cell}
+    if border:
+        map_config['border'] = rescale / 100
+
+    with tempfile.TemporaryDirectory() as folder:
+        app = create_app({'SQLALCHEMY_DATABASE_URI':
+                          f'sqlite:///{os.path.join(folder, "benchmark.sqlite3")}'})
+        with app.app_context():
+            db.create_all()
+            results, summary = run_benchmark(stars, ticks, churn, players, seed,
+                                             map_config, encode, profile)
+            db.session.remove()
+            db.engine.dispose()
+
+    if baseline is not None:
+        with open(baseline) as f:
+            baseline = json.load(f)
+        if baseline['config'] != config:
+            click.echo('Warning: the baseline was run with a different configuration')
+    print_results(results, summary, baseline)
+
+    if save_path is not None:
+        with open(save_path, 'w') as f:
+            json.dump({'config': config, 'stages': results, 'summary': summary}, f, indent=2)
+    if baseline is not None:
+        slower = [name for name, result in results.items() if name in baseline['stages']
+                  and result['seconds'] > baseline['stages'][name]['seconds'] * (1 + tolerance)]
+        if slower:
+            raise click.ClickException(f'Slower than the baseline: {", ".join(slower)}')
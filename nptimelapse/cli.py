@@ -1,18 +1,29 @@
 import click
 from flask import current_app
 from flask.cli import with_appcontext
-from sqlalchemy import func
+from sqlalchemy import func, insert, inspect, text
 # from werkzeug.security import generate_password_hash
 
+from nptimelapse.encoding import FORMATS
+from nptimelapse.compaction import owner_rows, drop_repeats, pack_game
 from nptimelapse.extensions import db
+from nptimelapse.fetch import fetch_game, np2stats_history
+from nptimelapse.ingest import IngestError, import_np2stats
 from nptimelapse.model import *
+from nptimelapse.snapshots import last_snapshots, snapshot_interval, record_snapshot, \
+                                  build_snapshots
+from nptimelapse.video_cache import cache_folder, evict, remove
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from itertools import repeat
 import requests
+import requests.adapters
 import logging
 import os
 import os.path
 import glob
+import json
 
 
 # Used to set up the database after installation or changing the model.
@@ -30,22 +41,88 @@ def init_db(reset):
     print('Database initialised.')
 
 
+# Used to bring a database created by an older version up to date without
+# losing data. Safe to run more than once.
+@click.command('upgrade-db')
+@with_appcontext
+def upgrade_db():
+    db.create_all()
+    # The video table only indexes the video cache, recreate it if outdated
+    columns = {column['name'] for column in inspect(db.engine).get_columns('video')}
+    if columns != set(Video.__table__.columns.keys()):
+        Video.__table__.drop(db.engine)
+        Video.__table__.create(db.engine)
+        print('Video cache index recreated, run purge-videos --all to clear old videos.')
+    # So does the job table for running jobs
+    columns = {column['name'] for column in inspect(db.engine).get_columns('job')}
+    if columns != set(Job.__table__.columns.keys()):
+        Job.__table__.drop(db.engine)
+        Job.__table__.create(db.engine)
+        print('Job table recreated.')
+    for index in Owner.__table__.indexes:
+        index.create(db.engine, checkfirst=True)
+    print('Indexes created.')
+
+    # Tick ranges of games, computed once from the whole history
+    columns = {column['name'] for column in inspect(db.engine).get_columns('game')}
+    for column in ('start_tick', 'end_tick'):
+        if column not in columns:
+            db.session.execute(text(f'ALTER TABLE game ADD COLUMN {column} INTEGER'))
+    ranges = db.session.query(Owner.game_id, func.min(Owner.tick), func.max(Owner.tick)) \
+        .group_by(Owner.game_id)
+    db.session.bulk_update_mappings(Game, [
+        {'id': game_id, 'start_tick': start_tick, 'end_tick': end_tick}
+        for game_id, start_tick, end_tick in ranges])
+    db.session.commit()
+    print('Tick ranges recorded.')
+
+    # Rebuild the current owner snapshot from the whole history
+    last_tick = db.session.query(Owner.game_id, Owner.star_id,
+                                 func.max(Owner.tick).label('tick')) \
+        .group_by(Owner.game_id, Owner.star_id).subquery()
+    current = db.session.query(Owner.game_id, Owner.star_id, Owner.tick, Owner.player) \
+        .join(last_tick, (Owner.game_id == last_tick.c.game_id)
+                         & (Owner.star_id == last_tick.c.star_id)
+                         & (Owner.tick == last_tick.c.tick))
+    db.session.query(CurrentOwner).delete()
+    db.session.execute(insert(CurrentOwner).from_select(
+        ['game_id', 'star_id', 'tick', 'player'], current))
+    db.session.commit()
+    print('Current owners rebuilt.')
+
+
+# Latest recorded owner of every star of a game
+def latest_owners(game_id):
+    owners = db.session.query(CurrentOwner.star_id, CurrentOwner.player) \
+        .filter(CurrentOwner.game_id == game_id).all()
+    return dict(owners)
+
+
 # Used to fetch data from the np server. Run at least every hour.
 @click.command('fetch-owners')
 @click.option('--test/--no-test', default=False)
 @click.option('--close/--no-close', default=False)
+@click.option('--workers', default=8, help='Number of games fetched at once.')
 @with_appcontext
-def fetch_owners(test, close):
+def fetch_owners(test, close, workers):
     logging.basicConfig(format='%(asctime)s|%(levelname)s| %(message)s', level=logging.INFO)
     games = Game.query.filter(Game.close_date == None).all()
+    new_stars = []
     new_owners = []
-    for game in games:
-        logging.info(f'Fetching game {game.name}:{game.id}...')
-        # Fetch current star owners
-        params = {'game_number': game.id,
-                         'code': game.api_key,
-                  'api_version': 0.1}
-        payload = requests.post('https://np.ironhelmet.com/api', params).json()
+    new_snapshots = []
+    snapshots = last_snapshots()
+
+    # Fetch games concurrently over pooled connections
+    session = requests.Session()
+    session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=workers))
+    executor = ThreadPoolExecutor(workers)
+    payloads = executor.map(fetch_game,
+                            [game.id for game in games],
+                            [game.api_key for game in games],
+                            repeat(session))
+
+    for game, payload in zip(games, payloads):
+        logging.info(f'Fetched game {game.name}:{game.id}')
         if 'error' in payload:
             # TODO: allow for updating the api_key
             # Errors at this point usually result from a changed api_key.
@@ -61,30 +138,115 @@ def fetch_owners(test, close):
             logging.info(f'Closed a finished game {game.id}')
         # Otherwise compare and update
         # TODO: add previously unseen stars to facilitate dark galaxies
+        stars = {star_id for (star_id,) in
+                 db.session.query(Star.id).filter(Star.game_id == game.id)}
+        owners = latest_owners(game.id)
+        changes = len(new_owners)
         for star_id, star_data in data['stars'].items():
-            star = Star.query.filter(Star.game_id == game.id).filter(Star.id == int(star_id)).one_or_none()
-            if star is None:
-                new_owners.append(Star(id=int(star_id), game_id=game.id, x=star_data['x'], y=star_data['y']))
-            owner = Owner.query.filter(Owner.game_id == game.id) \
-                   .filter(Owner.star_id == int(star_id)) \
-                   .order_by(Owner.tick.desc()).first()
+            if int(star_id) not in stars:
+                new_stars.append({'id': int(star_id), 'game_id': game.id,
+                                  'x': star_data['x'], 'y': star_data['y']})
+            owner = owners.get(int(star_id))
             if owner is None and star_data['puid'] != -1 \
-            or owner is not None and owner.player != star_data['puid']:
-                new_owners.append(Owner(tick=data['tick'], star_id=int(star_id),
-                                        game_id=game.id, player=star_data['puid']))
+            or owner is not None and owner != star_data['puid']:
+                new_owners.append({'tick': data['tick'], 'star_id': int(star_id),
+                                   'game_id': game.id, 'player': star_data['puid']})
+        if len(new_owners) > changes:
+            record_tick(game, data['tick'])
+        # Keyframe of all owners every few ticks
+        if game.id not in snapshots or data['tick'] - snapshots[game.id] >= snapshot_interval():
+            owners.update((int(star_id), star_data['puid'])
+                          for star_id, star_data in data['stars'].items())
+            new_snapshots.append((game.id, data['tick'], owners))
+    executor.shutdown()
+
     # Add new data to db
-    db.session.add_all(new_owners)
     if not test:
+        if new_stars:
+            db.session.execute(insert(Star), new_stars)
+        if new_owners:
+            record_owners(new_owners)
+        for snapshot in new_snapshots:
+            record_snapshot(*snapshot)
+        db.session.commit()
+    logging.info(f'Fetching complete, {len(new_owners)} owner changes')
+
+
+# Used to rebuild keyframes of recorded games, for example after changing
+# SNAPSHOT_INTERVAL or for games recorded before keyframes existed.
+@click.command('build-snapshots')
+@click.argument('game_ids', nargs=-1, type=int)
+@with_appcontext
+def build_snapshots_command(game_ids):
+    if not game_ids:
+        game_ids = [game_id for (game_id,) in db.session.query(Game.id)]
+    for game_id in game_ids:
+        build_snapshots(game_id)
+        db.session.commit()
+        print(f'Built snapshots of game {game_id}')
+
+
+# Used to record a game from np2stats, or from a timelapsedata file saved from
+# it, in the database. It is then listed and rendered like registered games.
+@click.command('import-game')
+@click.option('--file', 'path', type=click.Path(exists=True), help='Saved timelapsedata file.')
+@click.option('--game-id', help='np2stats game number.')
+@click.option('--player-id', help='np2stats player ID.')
+@click.option('--key', help='np2stats authentication key.')
+@click.option('--api-key', default='', help='API key to keep fetching a running game with.')
+@click.option('--replace/--no-replace', default=False)
+@with_appcontext
+def import_game(path, game_id, player_id, key, api_key, replace):
+    if path is not None:
+        with open(path) as f:
+            payload = json.load(f)
+    elif None in (game_id, player_id, key):
+        raise click.UsageError('Give a --file or all of --game-id, --player-id and --key')
+    else:
+        payload = np2stats_history({'game_id': game_id, 'player_id': player_id, 'key': key})
+    try:
+        game, changes = import_np2stats(payload, api_key, replace)
+    except IngestError as e:
+        raise click.ClickException(f'{e}, use --replace to import it again')
+    db.session.commit()
+    print(f'Imported game {game.name}:{game.id}, {changes} owner changes '
+          f'over ticks {game.start_tick}-{game.end_tick}')
+
+
+# Used to shrink the stored history of games. Removes owner rows repeating the
+# previous owner of their star and packs closed games into a single row.
+@click.command('compact-games')
+@click.argument('game_ids', nargs=-1, type=int)
+@click.option('--pack/--no-pack', default=True)
+@with_appcontext
+def compact_games(game_ids, pack):
+    games = Game.query.filter(Game.id.in_(game_ids)) if game_ids else Game.query
+    packed = {game_id for (game_id,) in db.session.query(PackedHistory.game_id)}
+    for game in games.order_by(Game.id).all():
+        if game.id in packed:
+            continue
+        if pack and game.close_date is not None:
+            rows = owner_rows(game.id)
+            size = pack_game(game.id)
+            print(f'Packed game {game.id}, {rows} owner rows into {size} bytes')
+        else:
+            removed = drop_repeats(game.id)
+            print(f'Removed {removed} repeated owner rows of game {game.id}')
         db.session.commit()
-    logging.info('Fetching complete')
 
 
-# Used to reset the video cache and allow new timelapses to be created.
+# Used to shrink the video cache to its configured size. With --all clears it
+# completely, also removing videos left by older versions.
 @click.command('purge-videos')
+@click.option('--all/--no-all', 'purge_all', default=False)
 @with_appcontext
-def purge_videos():
-    video_cache = os.path.join(current_app.instance_path, 'video_cache')
-    if os.path.exists(video_cache):
-        videos = glob.glob(os.path.join(video_cache, '*.mp4'))
-        for video in videos:
+def purge_videos(purge_all):
+    if not purge_all:
+        evict()
+        return
+    for video in Video.query.all():
+        remove(video)
+    db.session.commit()
+    for extension in {video_format['extension'] for video_format in FORMATS.values()}:
+        for video in glob.glob(os.path.join(cache_folder(), f'*.{extension}')):
             os.remove(video)
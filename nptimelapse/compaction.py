@@ -0,0 +1,46 @@
+from sqlalchemy import func, insert
+
+from nptimelapse.extensions import db
+from nptimelapse.history import History
+from nptimelapse.ingest import batches
+from nptimelapse.model import Owner, CurrentOwner, Snapshot, PackedHistory
+
+import zlib
+
+
+def owner_rows(game_id):
+    return db.session.query(func.count()).select_from(Owner) \
+        .filter(Owner.game_id == game_id).scalar()
+
+
+# Rewrite the owner rows of a game keeping only ownership transitions, for
+# games recorded before they were enforced. Returns the number of rows removed.
+def drop_repeats(game_id):
+    rows = owner_rows(game_id)
+    history = History.from_db(game_id)
+    if len(history.ticks) == rows:
+        return 0
+    star_ids = history.star_ids[history.stars].tolist()
+    changes = [{'tick': tick, 'star_id': star_id, 'game_id': game_id, 'player': player}
+               for tick, star_id, player in
+               zip(history.ticks.tolist(), star_ids, history.players.tolist())]
+    for model in (CurrentOwner, Owner):
+        model.query.filter(model.game_id == game_id).delete()
+    for batch in batches(changes):
+        db.session.execute(insert(Owner), batch)
+    # Changes are in tick order so the last one of each star is current
+    current = {change['star_id']: change for change in changes}
+    for batch in batches(current.values()):
+        db.session.execute(insert(CurrentOwner), batch)
+    return rows - len(changes)
+
+
+# Replace the owner rows and keyframes of a closed game with its history
+# packed into one row. Returns the size of the packed history in bytes.
+def pack_game(game_id):
+    history = History.from_db(game_id)
+    packed = zlib.compress(history.to_bytes())
+    db.session.merge(PackedHistory(game_id=game_id, history=packed))
+    for model in (Snapshot, CurrentOwner, Owner):
+        model.query.filter(model.game_id == game_id).delete()
+    return len(packed)
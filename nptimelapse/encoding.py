@@ -0,0 +1,59 @@
+from flask import current_app
+
+from moviepy.video.io.ffmpeg_writer import FFMPEG_VideoWriter
+
+
+# Output formats: file extension, mimetype, ffmpeg codec and options, and
+# whether videos in it can be joined by stream copy, which rendering in
+# segments and extending cached videos rely on
+FORMATS = {
+    'mp4': {'extension': 'mp4', 'mimetype': 'video/mp4', 'codec': 'libx264',
+            'params': [], 'joinable': True},
+    # Lossless animations suit the few flat colors of a map
+    'webp': {'extension': 'webp', 'mimetype': 'image/webp', 'codec': 'libwebp_anim',
+             'params': ['-loop', '0'], 'joinable': False},
+    'apng': {'extension': 'png', 'mimetype': 'image/apng', 'codec': 'apng',
+             'params': ['-plays', '0', '-f', 'apng'], 'joinable': False},
+}
+
+# Encoding profiles by name. Besides the format they can set fps, the x264
+# or libwebp preset, crf, tune, lossless and the number of encoder threads.
+PROFILES = {
+    'default': {'format': 'mp4', 'fps': 24},
+    'fast': {'format': 'mp4', 'fps': 24, 'preset': 'ultrafast'},
+    'small': {'format': 'mp4', 'fps': 24, 'preset': 'slower', 'crf': 30, 'tune': 'animation'},
+    'webp': {'format': 'webp', 'fps': 12, 'preset': 'drawing', 'lossless': True},
+    'apng': {'format': 'apng', 'fps': 12},
+}
+DEFAULT_PROFILE = 'default'
+
+
+def profiles():
+    return current_app.config.get('TIMELAPSE_PROFILES', PROFILES)
+
+
+# Settings of a profile, None for unknown names
+def profile_settings(name):
+    return profiles().get(name)
+
+
+def profile_format(profile):
+    return FORMATS[profile.get('format', 'mp4')]
+
+
+# Writer streaming frames of a map into a file with the settings of a profile
+def video_writer(path, m, profile):
+    video_format = profile_format(profile)
+    params = list(video_format['params'])
+    if 'crf' in profile:
+        params += ['-crf', str(profile['crf'])]
+    if 'tune' in profile:
+        params += ['-tune', profile['tune']]
+    if profile.get('lossless'):
+        params += ['-lossless', '1']
+    default_preset = 'medium' if video_format['codec'] == 'libx264' else 'default'
+    return FFMPEG_VideoWriter(path, m.im_size, profile.get('fps', 24),
+                              codec=video_format['codec'],
+                              preset=profile.get('preset', default_preset),
+                              threads=profile.get('threads'),
+                              ffmpeg_params=params)
@@ -0,0 +1,147 @@
+from flask import current_app
+
+import hashlib
+import json
+import os
+import os.path
+import tempfile
+import time
+from collections import OrderedDict
+from threading import Lock
+import requests
+
+
+NP_API = 'https://np.ironhelmet.com/api'
+NP2STATS_API = 'https://np2stats.dysp.info/api/timelapsedata.php'
+# Seconds to wait for an API before giving up
+FETCH_TIMEOUT = 60
+# Default seconds fetched np2stats data is reused for
+FETCH_CACHE_TTL = 600
+# Fetched responses kept in memory, the disk cache has no size limit
+FETCH_CACHE_SIZE = 16
+# Query parameters that select an np2stats game
+NP2STATS_PARAMS = ('game_id', 'player_id', 'key')
+
+
+# Pooled connections shared by everything in the process
+session = requests.Session()
+session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=16))
+
+# Cached responses by key, least recently used first
+cache = OrderedDict()
+cache_lock = Lock()
+
+
+def cache_ttl():
+    return current_app.config.get('FETCH_CACHE_TTL', FETCH_CACHE_TTL)
+
+
+# Responses are also kept on disk so that the celery worker reuses what the
+# web process already fetched
+def cache_folder():
+    if not current_app.config.get('FETCH_CACHE_DISK', True):
+        return None
+    folder = os.path.join(current_app.instance_path, 'fetch_cache')
+    if not os.path.exists(folder):
+        os.mkdir(folder)
+    return folder
+
+
+def cache_key(name, params):
+    params = json.dumps({'name': name, 'params': params}, sort_keys=True)
+    return hashlib.sha256(params.encode()).hexdigest()
+
+
+# Value made by make_value for a name and params, reused for FETCH_CACHE_TTL
+def cached(name, params, make_value):
+    key = cache_key(name, params)
+    ttl = cache_ttl()
+    now = time.time()
+    with cache_lock:
+        entry = cache.get(key)
+        if entry is not None and now - entry['time'] < ttl:
+            cache.move_to_end(key)
+            return entry['value']
+    folder = cache_folder()
+    path = None if folder is None else os.path.join(folder, f'{key}.json')
+    entry = None
+    if path is not None and os.path.exists(path) and now - os.path.getmtime(path) < ttl:
+        try:
+            with open(path) as f:
+                entry = {'time': os.path.getmtime(path), 'value': json.load(f)}
+        except (OSError, ValueError):
+            entry = None
+    if entry is None:
+        entry = {'time': now, 'value': make_value()}
+        if path is not None:
+            prune(folder, ttl)
+            # Write aside and move so readers never see a partial file. Every
+            # writer has its own temporary file, also threads of one process.
+            descriptor, temp = tempfile.mkstemp(suffix='.tmp', dir=folder)
+            with os.fdopen(descriptor, 'w') as f:
+                json.dump(entry['value'], f)
+            # Readable like other files for a worker running as another user
+            os.chmod(temp, 0o644)
+            os.replace(temp, path)
+    with cache_lock:
+        cache[key] = entry
+        cache.move_to_end(key)
+        while len(cache) > FETCH_CACHE_SIZE:
+            cache.popitem(last=False)
+    return entry['value']
+
+
+# Remove expired responses from the disk cache
+def prune(folder, ttl):
+    now = time.time()
+    for name in os.listdir(folder):
+        path = os.path.join(folder, name)
+        try:
+            if now - os.path.getmtime(path) >= ttl:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+def np2stats_params(params):
+    return {name: str(params[name]) for name in NP2STATS_PARAMS if name in params}
+
+
+# Full timelapse data of an np2stats game
+def np2stats_history(params):
+    params = np2stats_params(params)
+
+    def download():
+        response = session.get(NP2STATS_API, params=params, timeout=FETCH_TIMEOUT)
+        response.raise_for_status()
+        return response.json()
+    return cached('np2stats_history', params, download)
+
+
+# Name, state and tick range of an np2stats game, kept apart from the full
+# data so pages showing a game don't parse it again
+def np2stats_game(params):
+    params = np2stats_params(params)
+
+    def summarize():
+        payload = np2stats_history(params)
+        ticks = [int(tick) for star in payload['stars'].values() for tick in star['owners']]
+        return {'id': payload['id'],
+              'name': payload['name'],
+           'updated': payload['updated'],
+         'game_over': payload['game_over'],
+        'start_tick': min(ticks),
+          'end_tick': max(ticks)}
+    return cached('np2stats_game', params, summarize)
+
+
+# Current scanning data of a game from the np server. Never cached, failed
+# requests are reported like API errors.
+def fetch_game(game_id, api_key, session=session):
+    params = {'game_number': game_id,
+                     'code': api_key,
+              'api_version': '0.1'}
+    try:
+        return session.post(NP_API, params, timeout=FETCH_TIMEOUT).json()
+    except (requests.RequestException, ValueError) as e:
+        return {'error': f'request failed: {e}'}
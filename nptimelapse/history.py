@@ -0,0 +1,152 @@
+from nptimelapse.extensions import db
+from nptimelapse.model import Star, Owner, PackedHistory
+
+from collections import namedtuple
+import struct
+import zlib
+import numpy as np
+
+
+StarPoint = namedtuple('StarPoint', 'id x y')
+Change = namedtuple('Change', 'star_id player')
+
+# Binary layout, all little endian:
+#   header: magic b'NPTH', format version, star count, change count,
+#           first and last recorded tick
+#   stars:   ids int32[], x float64[], y float64[]
+#   changes: tick int32[], star index uint16[], player int8[]
+# Changes are sorted by tick and only hold actual ownership transitions.
+MAGIC = b'NPTH'
+VERSION = 1
+HEADER = struct.Struct('<4sHIIii')
+
+
+# Columnar history of a game: star coordinates and ownership changes
+class History:
+    def __init__(self, star_ids, star_x, star_y, ticks, stars, players,
+                 first_tick=None, last_tick=None):
+        self.star_ids = np.asarray(star_ids, np.int32)
+        self.star_x = np.asarray(star_x, np.float64)
+        self.star_y = np.asarray(star_y, np.float64)
+        # Parallel arrays of changes, stars given by index
+        order = np.argsort(ticks, kind='stable')
+        self.ticks = np.asarray(ticks, np.int32)[order]
+        self.stars = np.asarray(stars, np.uint16)[order]
+        self.players = np.asarray(players, np.int8)[order]
+        self.drop_repeats()
+        if first_tick is None:
+            first_tick = int(self.ticks[0]) if len(self.ticks) else 0
+        if last_tick is None:
+            last_tick = int(self.ticks[-1]) if len(self.ticks) else 0
+        self.first_tick = first_tick
+        self.last_tick = last_tick
+
+    @classmethod
+    def from_db(cls, game_id):
+        history = cls.from_packed(game_id)
+        if history is not None:
+            return history
+        stars = db.session.query(Star.id, Star.x, Star.y) \
+            .filter(Star.game_id == game_id).order_by(Star.id).all()
+        star_ids = np.array([star.id for star in stars], np.int32)
+        rows = db.session.query(Owner.tick, Owner.star_id, Owner.player) \
+            .filter(Owner.game_id == game_id) \
+            .order_by(Owner.tick).yield_per(1000)
+        changes = np.array(list(rows), np.int64).reshape(-1, 3)
+        return cls(star_ids,
+                   [star.x for star in stars],
+                   [star.y for star in stars],
+                   changes[:, 0],
+                   np.searchsorted(star_ids, changes[:, 1]),
+                   changes[:, 2])
+
+    # History of a game packed by nptimelapse.compaction, None if it isn't
+    @classmethod
+    def from_packed(cls, game_id):
+        packed = db.session.get(PackedHistory, game_id)
+        if packed is None:
+            return None
+        return cls.from_bytes(zlib.decompress(packed.history))
+
+    # From an np2stats timelapsedata payload
+    @classmethod
+    def from_np2stats(cls, payload):
+        star_ids = sorted(int(star_id) for star_id in payload['stars'])
+        index = {star_id: i for i, star_id in enumerate(star_ids)}
+        ticks, stars, players = [], [], []
+        for star_id, star in payload['stars'].items():
+            for tick, player in star['owners'].items():
+                ticks.append(int(tick))
+                stars.append(index[int(star_id)])
+                players.append(int(player))
+        return cls(star_ids,
+                   [float(payload['stars'][str(i)]['x']) for i in star_ids],
+                   [float(payload['stars'][str(i)]['y']) for i in star_ids],
+                   ticks, stars, players,
+                   min(ticks, default=0), max(ticks, default=0))
+
+    @classmethod
+    def from_bytes(cls, data):
+        magic, version, n_stars, n_changes, first_tick, last_tick = \
+            HEADER.unpack_from(data)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('Not a game history')
+        arrays = []
+        offset = HEADER.size
+        for dtype, count in (('<i4', n_stars), ('<f8', n_stars), ('<f8', n_stars),
+                             ('<i4', n_changes), ('<u2', n_changes), ('<i1', n_changes)):
+            arrays.append(np.frombuffer(data, dtype, count, offset))
+            offset += arrays[-1].nbytes
+        return cls(*arrays, first_tick, last_tick)
+
+    def to_bytes(self):
+        header = HEADER.pack(MAGIC, VERSION, len(self.star_ids), len(self.ticks),
+                             self.first_tick, self.last_tick)
+        return b''.join([header,
+                         self.star_ids.astype('<i4').tobytes(),
+                         self.star_x.astype('<f8').tobytes(),
+                         self.star_y.astype('<f8').tobytes(),
+                         self.ticks.astype('<i4').tobytes(),
+                         self.stars.astype('<u2').tobytes(),
+                         self.players.astype('<i1').tobytes()])
+
+    # Keep only changes where a star's owner actually differs from before
+    def drop_repeats(self):
+        order = np.lexsort((self.ticks, self.stars))
+        stars = self.stars[order]
+        players = self.players[order]
+        first = np.ones(len(order), bool)
+        first[1:] = stars[1:] != stars[:-1]
+        previous = np.full(len(order), -1, np.int8)
+        previous[1:] = players[:-1]
+        previous[first] = -1  # Stars start unowned
+        keep = np.empty(len(order), bool)
+        keep[order] = players != previous
+        self.ticks = self.ticks[keep]
+        self.stars = self.stars[keep]
+        self.players = self.players[keep]
+
+    # Stars in the form Map expects
+    def star_points(self):
+        return [StarPoint(*star) for star in
+                zip(self.star_ids.tolist(), self.star_x.tolist(), self.star_y.tolist())]
+
+    # Owner of every star, by index, after all changes up to a tick
+    def owners_at(self, tick):
+        end = np.searchsorted(self.ticks, tick, side='right')
+        owners = np.full(len(self.star_ids), -1, np.int16)
+        # Only the last change of each star counts
+        stars = self.stars[:end][::-1]
+        stars, last = np.unique(stars, return_index=True)
+        owners[stars] = self.players[:end][::-1][last]
+        return owners
+
+    # Changes of each tick in a range, in the form Map.update expects
+    def tick_owners(self, start_tick=None, end_tick=None):
+        start_tick = self.first_tick if start_tick is None else start_tick
+        end_tick = self.last_tick if end_tick is None else end_tick
+        bounds = np.searchsorted(self.ticks, np.arange(start_tick, end_tick + 2))
+        star_ids = self.star_ids[self.stars].tolist()
+        players = self.players.tolist()
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            yield [Change(star_ids[i], players[i]) for i in range(start, end)]
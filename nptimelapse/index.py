@@ -1,19 +1,26 @@
 from flask import Blueprint, render_template, url_for, flash, request, send_file, \
                   current_app, abort
 from werkzeug.utils import redirect
-from sqlalchemy.sql import func
 from celery.exceptions import TimeoutError
 
+from nptimelapse.encoding import DEFAULT_PROFILE, FORMATS, profiles, profile_format
 from nptimelapse.extensions import db
-from nptimelapse.model import Game, Star, Owner
-from nptimelapse.tasks import make_timelapse, TimelapseTmpFolderExistsError
-from nptimelapse.map_maker import COLS
+from nptimelapse.fetch import fetch_game, np2stats_game
+from nptimelapse.model import Game, Star, record_owners, record_tick
+from nptimelapse.tasks import make_timelapse
+from nptimelapse.map_maker import Map, COLS, RESCALE, PIX_PER_CELL
+from nptimelapse.snapshots import owners_at
+from nptimelapse.video_cache import video_variant, video_key, video_path, lookup, \
+                                    job_status, claim_job, unclaim_job, retry_job
 
-import requests
-import glob
 import os
 import os.path
+from collections import OrderedDict
 from datetime import datetime
+from io import BytesIO
+from threading import Lock
+import time
+from uuid import uuid4
 
 
 bp = Blueprint('index', __name__, url_prefix='')
@@ -28,10 +35,7 @@ def browse_games():
 
         # Fetch game data from ironhelmet API and database
         exists = Game.query.filter(Game.id == game_id).one_or_none()
-        params = {'game_number': game_id,
-                         'code': api_key,
-                  'api_version': '0.1'}
-        payload = requests.post('https://np.ironhelmet.com/api', params).json()
+        payload = fetch_game(game_id, api_key)
 
         # Handle API errors
         if 'error' in payload:
@@ -40,6 +44,8 @@ def browse_games():
                 flash('Incorrect API key')
             elif error == 'api_version not supported':
                 flash('API error. Contact the site owner')
+            elif error.startswith('request failed'):
+                flash('Could not reach the Neptune\'s Pride server, try again later')
             else:
                 flash('Incorrect game number')
         # Check if game already exists
@@ -55,48 +61,76 @@ def browse_games():
         else:
             # Register the new game in DB
             data = payload['scanning_data']
-            db.session.add(Game(id=game_id, api_key=api_key, name=data['name']))
+            game = Game(id=game_id, api_key=api_key, name=data['name'])
+            db.session.add(game)
             new_stars = [Star(id=int(star_id),
                               game_id=game_id,
                               x=float(star['x']),
                               y=float(star['y']))
                          for star_id, star in data['stars'].items()]
             db.session.add_all(new_stars)
-            new_owners = [Owner(tick=data['tick'],
-                                star_id=int(star_id),
-                                game_id=game_id,
-                                player=star['puid'])
-                          for star_id, star in data['stars'].items() if star['puid'] >= 0]
-            db.session.add_all(new_owners)
+            new_owners = [{'tick': data['tick'],
+                           'star_id': int(star_id),
+                           'game_id': int(game_id),
+                           'player': star['puid']}
+                          for star_id, star in data['stars'].items()]
+            db.session.flush()
+            # Unowned stars are not recorded
+            if record_owners(new_owners):
+                record_tick(game, data['tick'])
             db.session.commit()
+            listings.clear()
             return redirect(url_for('index.game_info', source_id=game_id))
 
         # If an error happened the normal page is displayed
 
-    # Query games
-    games = db.session.query(func.min(Owner.tick), func.max(Owner.tick), Game) \
-        .join(Game.owners).group_by(Game.id) \
-        .order_by(Game.close_date, Game.name, Game.id).all()
+    page = request.args.get('page', 1, type=int)
+    page, games, pages = game_listing(page)
+    return render_template('browse_games.html', games=games, page=page, pages=pages)
 
-    games = [{'start_tick': g[0],
-                'end_tick': g[1],
-                  'number': g[2].id,
-                    'name': g[2].name,
-              'close_date': g[2].close_date}
+
+# Games shown on one page of the listing
+GAMES_PER_PAGE = 30
+# Seconds a page of the listing is reused for
+LISTING_TTL = 60
+# Pages of the listing by page number, with the time they were queried
+listings = {}
+
+
+# Games on a page of the listing and the number of pages. Pages out of range
+# are clamped to the first or last one, which is returned too.
+def game_listing(page):
+    listing = listings.get(page)
+    if listing is not None and time.time() - listing['time'] < LISTING_TTL:
+        return page, listing['games'], listing['pages']
+
+    per_page = current_app.config.get('GAMES_PER_PAGE', GAMES_PER_PAGE)
+    recorded = Game.query.filter(Game.start_tick != None)
+    pages = max(1, -(-recorded.count() // per_page))
+    # Only pages that exist are cached
+    page = min(max(page, 1), pages)
+    games = recorded.order_by(Game.close_date, Game.name, Game.id) \
+        .offset((page - 1) * per_page).limit(per_page).all()
+    games = [{'start_tick': g.start_tick,
+                'end_tick': g.end_tick,
+                  'number': g.id,
+                    'name': g.name,
+              'close_date': g.close_date}
              for g in games]
-    return render_template('browse_games.html', games=games)
+    listings[page] = {'time': time.time(), 'games': games, 'pages': pages}
+    return page, games, pages
 
 
 @bp.route('/game/<string:source_id>')
 def game_info(source_id):
     if source_id.isnumeric():
         # Query game
-        game_data = db.session.query(func.min(Owner.tick), func.max(Owner.tick), Game) \
-            .filter(Game.id == int(source_id)).join(Game.owners).group_by(Game.id).one_or_none()
-        if game_data is None:
+        game = Game.query.filter(Game.id == int(source_id)) \
+            .filter(Game.start_tick != None).one_or_none()
+        if game is None:
             flash(f'Game {source_id} is not registered!')
             return redirect(url_for('index.browse_games'))
-        start_tick, end_tick, game = game_data
+        start_tick, end_tick = game.start_tick, game.end_tick
     elif source_id == 'np2stats':
         incorrect_request = False
         if 'game_id' not in request.args:
@@ -110,17 +144,18 @@ def game_info(source_id):
             incorrect_request = True
         if incorrect_request:
             return redirect(url_for('index.browse_games'))
-        payload = requests.get('https://np2stats.dysp.info/api/timelapsedata.php', params=request.args).json()
-        start_tick = min(min(int(tick) for tick in star['owners']) for star in payload['stars'].values())
-        end_tick = max(max(int(tick) for tick in star['owners']) for star in payload['stars'].values())
-        game = Game(id=payload['id'], name=payload['name'], api_key='',
-                    close_date=datetime.strptime(payload['updated'], '%Y-%m-%d %H:%M:%S')
-                               if payload['game_over'] else None)
+        summary = np2stats_game(request.args)
+        start_tick, end_tick = summary['start_tick'], summary['end_tick']
+        game = Game(id=summary['id'], name=summary['name'], api_key='',
+                    close_date=datetime.strptime(summary['updated'], '%Y-%m-%d %H:%M:%S')
+                               if summary['game_over'] else None)
     else:
         flash(f'Invalid game identifier: {source_id}!')
         return redirect(url_for('index.browse_games'))
     return render_template('game_info.html',
                            source_id=source_id,
+                           profiles=profiles(),
+                           default_profile=DEFAULT_PROFILE,
                            url_params=request.args,
                            game=game,
                            game_length=end_tick - start_tick + 1)
@@ -132,16 +167,69 @@ def interactive_timelapse(source_id):
                            source_id = source_id)
 
 
-@bp.route('/game/<string:source_id>/timelapse_request')
+# Map parameters for the timelapse options of a request, along with the
+# chosen star style, border style and smoothness
+def draw_options(args):
+    # Get request arguments
+    if 'star' in args:
+        star = args['star']
+    else:
+        star = 'none'
+    if 'border' in args:
+        border = args['border']
+    else:
+        border = 'none'
+    if 'rescale' in args:
+        smoothness = int(args['rescale']) + 1
+        rescale = 7 - smoothness
+        if rescale > 6:
+            rescale = 10
+    else:
+        smoothness = 1
+        rescale = 6
+
+    # Prepare map parameters
+    draw_params = {'rescale': rescale, 'pix_per_cell': 60 // rescale}
+    if star != 'none' :
+        if star == 'white':
+            draw_params['star_cols'] = tuple((255, 255, 255) for i in range(64))
+        elif star == 'black':
+            draw_params['star_cols'] = tuple((0, 0, 0) for i in range(64))
+        elif star == 'contrast':
+            draw_params['star_cols'] = tuple(
+                (0, 0, 0) if c[0]*.299 + c[1]*.587 + c[2]*.114 > 128
+                else (255, 255, 255) for c in COLS
+            )
+    if border != 'none':
+        draw_params['border'] = rescale / 100
+    return draw_params, star, border, smoothness
+
+
+# Timelapse painted by the browser, in any style without rendering a video
+@bp.route('/game/<int:game_id>/viewer')
+def timelapse_viewer(game_id):
+    game = Game.query.filter(Game.id == game_id) \
+        .filter(Game.start_tick != None).one_or_none()
+    if game is None:
+        flash(f'Game {game_id} is not registered!')
+        return redirect(url_for('index.browse_games'))
+    _, star, border, smoothness = draw_options(request.args)
+    return render_template('viewer.html',
+                           game=game,
+                           star=star, border=border,
+                           smoothness=smoothness)
+
+
+@bp.route('/game/<string:source_id>/timelapse_request', methods=('GET', 'POST'))
 def timelapse_request(source_id):
     if source_id.isnumeric():
         # Query game
-        game_data = db.session.query(func.min(Owner.tick), func.max(Owner.tick), Game) \
-            .filter(Game.id == int(source_id)).join(Game.owners).group_by(Game.id).one_or_none()
-        if game_data is None:
+        game = Game.query.filter(Game.id == int(source_id)) \
+            .filter(Game.start_tick != None).one_or_none()
+        if game is None:
             flash(f'Game {source_id} is not registered!')
             return redirect(url_for('index.browse_games'))
-        start_tick, end_tick, game = game_data
+        start_tick, end_tick = game.start_tick, game.end_tick
         url_params = {}
     elif source_id == 'np2stats':
         incorrect_request = False
@@ -156,78 +244,58 @@ def timelapse_request(source_id):
             incorrect_request = True
         if incorrect_request:
             return redirect(url_for('index.browse_games'))
-        payload = requests.get('https://np2stats.dysp.info/api/timelapsedata.php', params=request.args).json()
-        start_tick = min(min(int(tick) for tick in star['owners']) for star in payload['stars'].values())
-        end_tick = max(max(int(tick) for tick in star['owners']) for star in payload['stars'].values())
-        game = Game(id=payload['id'], name=payload['name'], api_key='',
-                    close_date=datetime.strptime(payload['updated'], '%Y-%m-%d %H:%M:%S')
-                               if payload['game_over'] else None)
+        summary = np2stats_game(request.args)
+        start_tick, end_tick = summary['start_tick'], summary['end_tick']
+        game = Game(id=summary['id'], name=summary['name'], api_key='',
+                    close_date=datetime.strptime(summary['updated'], '%Y-%m-%d %H:%M:%S')
+                               if summary['game_over'] else None)
         url_params = {key: request.args[key] for key in ('game_id', 'player_id', 'key')}
     else:
         flash(f'Invalid game identifier: {source_id}!')
         return redirect(url_for('index.browse_games'))
 
-    # Get request arguments
-    if 'star' in request.args:
-        star = request.args['star']
-    else:
-        star = 'none'
-    if 'border' in request.args:
-        border = request.args['border']
-    else:
-        border = 'none'
-    if 'rescale' in request.args:
-        smoothness = int(request.args['rescale']) + 1
-        rescale = 7 - smoothness
-        if rescale > 6:
-            rescale = 10
-    else:
-        smoothness = 1
-        rescale = 6
-    if 'dysp' in request.args and request.args['dysp'].isnumeric():
-        dysp = request.args['dysp']
-    else:
-        dysp = 0
+    draw_params, star, border, smoothness = draw_options(request.args)
+    profile = request.args.get('profile', DEFAULT_PROFILE)
+    if profile not in profiles():
+        flash(f'Unknown format {profile}, using the default one')
+        profile = DEFAULT_PROFILE
+    video_format = profile_format(profiles()[profile])
 
     # Timelapse status
-    video_cache = os.path.join(current_app.instance_path, 'video_cache')
-    tl_name = f'{game.name.replace(" ", "_")}_{game.id}_{source_id}_{star}_{border}_{rescale}_{dysp}.mp4'
-    tl_path = os.path.join(video_cache, tl_name)
-    tmp_folder = os.path.join(video_cache, 'tmp')
+    key = video_key(video_variant(source_id, game.id, draw_params, url_params, profile),
+                    end_tick)
+    tl_name = f'{key}.{video_format["extension"]}'
     game_length = end_tick - start_tick + 1
-    if os.path.exists(tl_path):
+    status = job_status(key)
+    if lookup(key) is not None:
         tl_status = 'READY'
         progress = game_length
-    elif os.path.exists(tmp_folder):
+    elif status is not None and status['phase'] == 'failed':
+        # Failed renders are only queued again when asked to or after a delay
+        if request.method == 'POST':
+            retry_job(key)
+            return redirect(request.full_path)
+        tl_status = 'FAILED'
+        progress = 0
+    elif status is not None:
         tl_status = 'IN_PROGRESS'
-        # An integer from the highest image name
-        files = glob.glob(os.path.join(tmp_folder, '*.png'))
-        if files:
-            progress = int(max(files)[-8:-4]) - start_tick
-        else:
-            progress = 0
+        progress = status['progress']
     else:
         tl_status = 'NOT_READY'
         progress = 0
 
     if tl_status == 'NOT_READY':
-        # Prepare map parameters
-        draw_params = {'rescale': rescale, 'pix_per_cell': 60 // rescale}
-        if star != 'none' :
-            if star == 'white':
-                draw_params['star_cols'] = tuple((255, 255, 255) for i in range(64))
-            elif star == 'black':
-                draw_params['star_cols'] = tuple((0, 0, 0) for i in range(64))
-            elif star == 'contrast':
-                draw_params['star_cols'] = tuple(
-                    (0, 0, 0) if c[0]*.299 + c[1]*.587 + c[2]*.114 > 128
-                    else (255, 255, 255) for c in COLS
-                )
-        if border != 'none':
-            draw_params['border'] = rescale / 100
-
-        # Make the timelapse
-        make_timelapse.delay(source_id, tl_name, draw_params, url_params)
+        # Make the timelapse, claiming the job first so that concurrent
+        # requests for the same video only queue it once
+        task_id = uuid4().hex
+        if claim_job(key, task_id):
+            try:
+                make_timelapse.apply_async((source_id, key, draw_params, url_params, end_tick,
+                                            profile), task_id=task_id)
+            except Exception:
+                # Otherwise the job would wait for a task that never comes
+                unclaim_job(key, task_id)
+                raise
         tl_status = 'IN_PROGRESS'
 
     return render_template('timelapse_request.html',
@@ -235,19 +303,129 @@ def timelapse_request(source_id):
                            url_params=url_params,
                            star=star, border=border,
                            smoothness=smoothness,
+                           profile=profile,
+                           mimetype=video_format['mimetype'],
+                           key=key,
                            tl_name=tl_name,
                            tl_status=tl_status,
                            progress=progress,
+                           phase=None if status is None else status['phase'],
                            game_length=game_length,
                            game=game)
 
 
+# Seconds browsers may keep a downloaded video, the content of a key never
+# changes
+VIDEO_MAX_AGE = 365 * 24 * 3600
+
+
 @bp.route('/game/<string:source_id>/timelapse/<string:tl_name>')
 def timelapse(source_id, tl_name):
-    tl_path = os.path.join(current_app.instance_path, f'video_cache/{tl_name}')
-    if not os.path.exists(tl_path):
+    key, ext = os.path.splitext(tl_name)
+    video = lookup(key)
+    if video is None or ext != f'.{FORMATS[video.format]["extension"]}':
+        abort(404)
+
+    accel = current_app.config.get('VIDEO_ACCEL_REDIRECT')
+    if accel:
+        # Let the proxy send the file, ranges included
+        response = current_app.response_class(mimetype=FORMATS[video.format]['mimetype'])
+        response.headers['X-Accel-Redirect'] = f'{accel.rstrip("/")}/{tl_name}'
+        response.headers.set('Content-Disposition', 'attachment', filename=video.name)
+        response.set_etag(key)
+        response = response.make_conditional(request)
+    else:
+        # Handles ranges and conditional requests, or hands the file to the
+        # server with USE_X_SENDFILE
+        response = send_file(video_path(key, video.format), as_attachment=True,
+                             mimetype=FORMATS[video.format]['mimetype'],
+                             download_name=video.name, etag=key, conditional=True,
+                             max_age=VIDEO_MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.max_age = VIDEO_MAX_AGE
+    response.cache_control.immutable = True
+    return response
+
+
+# Map presets of single frames
+FRAME_SIZES = {'thumb': {'rescale': 1, 'pix_per_cell': 4},
+                'full': {'rescale': RESCALE, 'pix_per_cell': PIX_PER_CELL}}
+# Maps of recently viewed games, least recently used first, each with a lock
+# of its own. At least a page of the listing is kept so thumbnails are reused.
+MAP_CACHE_SIZE = 32
+maps = OrderedDict()
+maps_lock = Lock()
+# Encoded frames by game, tick and size, least recently used first
+FRAME_CACHE_SIZE = 256
+frames = OrderedDict()
+
+
+def map_cache_size():
+    return max(MAP_CACHE_SIZE, current_app.config.get('GAMES_PER_PAGE', GAMES_PER_PAGE))
+
+
+# PNG of the owners of a game after a tick
+def render_frame(game_id, size, tick):
+    stars = db.session.query(Star.id, Star.x, Star.y) \
+        .filter(Star.game_id == game_id).order_by(Star.id).all()
+    if not stars:
+        return None
+    owners = owners_at(game_id, tick)
+    # Star geometry is kept, only the owners change between frames. The
+    # global lock only guards the cache, maps are built and drawn under their
+    # own lock.
+    key = (game_id, len(stars), size)
+    with maps_lock:
+        entry = maps.get(key)
+        if entry is None:
+            entry = maps[key] = {'map': None, 'lock': Lock()}
+            while len(maps) > map_cache_size():
+                maps.popitem(last=False)
+        maps.move_to_end(key)
+    image = BytesIO()
+    with entry['lock']:
+        if entry['map'] is None:
+            entry['map'] = Map(stars, **FRAME_SIZES[size])
+        m = entry['map']
+        m.set_owners([owners.get(star_id, -1) for star_id in m.stars])
+        m.image.save(image, 'PNG')
+    return image.getvalue()
+
+
+@bp.route('/game/<int:game_id>/frame/<int:tick>.png')
+def game_frame(game_id, tick):
+    size = request.args.get('size', 'full')
+    if size not in FRAME_SIZES:
         abort(404)
-    return send_file(tl_path, as_attachment=True)
+    game = Game.query.filter(Game.id == game_id).one_or_none()
+    if game is None:
+        abort(404)
+
+    # Frames after the last recorded tick are the same as its frame, and
+    # recorded ticks never change
+    if game.end_tick is not None:
+        tick = min(tick, game.end_tick)
+    key = (game_id, tick, size)
+    with maps_lock:
+        image = frames.get(key)
+        if image is not None:
+            frames.move_to_end(key)
+    if image is None:
+        image = render_frame(game_id, size, tick)
+        if image is None:
+            abort(404)
+        if game.end_tick is not None:
+            with maps_lock:
+                frames[key] = image
+                while len(frames) > FRAME_CACHE_SIZE:
+                    frames.popitem(last=False)
+
+    response = current_app.response_class(image, mimetype='image/png')
+    # Frames of past ticks never change
+    response.cache_control.public = True
+    response.cache_control.max_age = \
+        86400 if game.end_tick is not None and tick < game.end_tick else 60
+    return response
 
 
 @bp.route('/help')
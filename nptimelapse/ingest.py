@@ -0,0 +1,91 @@
+from sqlalchemy import insert
+
+from nptimelapse.extensions import db
+from nptimelapse.model import Game, Star, Owner, CurrentOwner, Snapshot, PackedHistory, \
+                              Video, record_owners, record_tick
+from nptimelapse.snapshots import build_snapshots
+from nptimelapse.video_cache import remove
+
+from datetime import datetime
+from itertools import islice
+
+
+# Rows sent to the database in one executemany
+IMPORT_BATCH = 5000
+
+
+class IngestError(Exception):
+    pass
+
+
+# Lists of at most size items taken from an iterable
+def batches(items, size=IMPORT_BATCH):
+    items = iter(items)
+    batch = list(islice(items, size))
+    while batch:
+        yield batch
+        batch = list(islice(items, size))
+
+
+# Ticks and players of a star's owners by tick where the owner changes,
+# the star starting unowned
+def transitions(owners):
+    previous = -1
+    for tick, player in sorted((int(tick), int(player)) for tick, player in owners.items()):
+        if player != previous:
+            previous = player
+            yield tick, player
+
+
+# Remove all recorded data of a game but the game itself
+def clear_game(game_id):
+    for video in Video.query.filter(Video.game_id == game_id):
+        remove(video)
+    for model in (PackedHistory, Snapshot, CurrentOwner, Owner, Star):
+        model.query.filter(model.game_id == game_id).delete()
+
+
+# Record a game from an np2stats timelapsedata payload so it is rendered from
+# the database like registered games. A game recorded before is only replaced
+# if asked to. Running games keep being fetched if given an API key.
+# Returns the game and the number of owner changes recorded.
+def import_np2stats(payload, api_key='', replace=False):
+    game_id = int(payload['id'])
+    game = db.session.get(Game, game_id)
+    if game is None:
+        game = Game(id=game_id, api_key=api_key)
+        db.session.add(game)
+    elif game.start_tick is not None and not replace:
+        raise IngestError(f'Game {game_id} is already recorded')
+    else:
+        clear_game(game_id)
+        game.start_tick = game.end_tick = None
+        if api_key:
+            game.api_key = api_key
+    game.name = payload['name'][:40]
+    if payload['game_over']:
+        game.close_date = datetime.strptime(payload['updated'], '%Y-%m-%d %H:%M:%S')
+    elif not game.api_key:
+        game.close_date = datetime.now()
+    db.session.flush()
+
+    stars = payload['stars']
+    for batch in batches({'id': int(star_id), 'game_id': game_id,
+                          'x': float(star['x']), 'y': float(star['y'])}
+                         for star_id, star in stars.items()):
+        db.session.execute(insert(Star), batch)
+
+    # Owner rows are made star by star as batches are sent. Like for fetched
+    # games the tick range only covers ticks with changes.
+    def owners():
+        for star_id, star in stars.items():
+            for tick, player in transitions(star['owners']):
+                record_tick(game, tick)
+                yield {'tick': tick, 'star_id': int(star_id),
+                       'game_id': game_id, 'player': player}
+
+    changes = 0
+    for batch in batches(owners()):
+        changes += len(record_owners(batch))
+    build_snapshots(game_id)
+    return game, changes
@@ -1,6 +1,5 @@
 import PIL.Image
-from PIL.ImageDraw import Draw
-from math import sqrt
+import numpy as np
 
 
 BASE = (
@@ -24,6 +23,23 @@ BOR = RESCALE / 100
 '''
 
 
+# Find the nearest of candidate stars for each point, -1 where no star is
+# near enough or two stars are closer to each other than the border width.
+# Matches the sequential scan the map used to do per pixel, ties included.
+def nearest_stars(mx, my, sx, sy, max_dist, border):
+    mx, my = np.broadcast_arrays(mx, my)
+    if len(sx) == 0:
+        return np.full(mx.shape, -1)
+    dist = np.sqrt((mx[..., None] - sx)**2 + (my[..., None] - sy)**2)
+    nearest = dist.argmin(axis=-1)
+    min_dist = np.take_along_axis(dist, nearest[..., None], -1)[..., 0]
+    # Distance to the runner up, the max distance counting as one
+    np.put_along_axis(dist, nearest[..., None], np.inf, -1)
+    second = np.minimum(dist.min(axis=-1), max_dist)
+    found = (min_dist < max_dist) & (np.abs(second - min_dist) > border)
+    return np.where(found, nearest, -1)
+
+
 class Map:
     def __init__(self, stars, max_dist=MAX_DIST, rescale=RESCALE, border=BORDER,
                  pix_per_cell=PIX_PER_CELL, cols=COLS, star_cols=COLS):
@@ -45,24 +61,61 @@ class Map:
         self.cols = tuple(tuple(t) for t in cols)  # Colors
         self.star_cols = tuple(tuple(t) for t in star_cols)  # Star colors
         self.border = border  # Border "width"
+        # Territory colors followed by star colors
+        self.palette = np.array(self.cols + self.star_cols, np.uint8)
 
         self.stars = {star.id: star for star in stars}
-        self.owners = {star.id: -1 for star in stars}
+        self.star_index = {star_id: i for i, star_id in enumerate(self.stars)}
+        self.star_x = np.array([star.x for star in self.stars.values()], float)
+        self.star_y = np.array([star.y for star in self.stars.values()], float)
+        self.owners = np.full(len(self.stars), -1)  # Owner of each star by index
+        self.dirty_pixels = 0  # Percieved pixels repainted by updates so far
         self.grid = []
         for x in range(self.grid_size[0]):
             self.grid.append([])
             for y in range(self.grid_size[1]):
                 self.grid[x].append([])
-        for star in self.stars.values():
+        for i, star in enumerate(self.stars.values()):
             cx, cy = self.map_to_cell(star.x, star.y)
-            self.grid[cx][cy].append(star)
+            self.grid[cx][cy].append(i)
 
-        self.image = PIL.Image.new('RGB', self.im_size, self.cols[-2])
-        self.draw = Draw(self.image)
+        # Stars never move so the nearest star of each percieved pixel is
+        # found once, -1 marking borders and empty space
+        dtype = np.int16 if len(self.stars) < 2**15 else np.int32
+        self.labels = np.full([(i - 1) * pix_per_cell for i in self.grid_size[::-1]],
+                              -1, dtype)
         for x in range(self.grid_size[0] - 1):
             for y in range(self.grid_size[1] - 1):
-                self.update_cell(x, y)
-        self.draw_stars()
+                self.labels[self.cell_slice(x, y)] = self.cell_labels(x, y)
+
+        # Percieved pixels of stars, later stars covering earlier ones
+        star_px = np.array([self.map_to_img(star.x, star.y)
+                            for star in self.stars.values()]).reshape(-1, 2)
+        _, last = np.unique(star_px[::-1], axis=0, return_index=True)
+        drawn = np.sort(len(star_px) - 1 - last)
+        drawn = drawn[(star_px[drawn] < self.labels.shape[::-1]).all(axis=1)]
+        self.star_drawn = drawn
+        self.star_px = tuple(star_px[drawn].T[::-1])
+
+        # Percieved pixels of each star's territory as flat canvas indices,
+        # those of star i being region_px[region_start[i]:region_start[i + 1]]
+        labels = self.labels.ravel()
+        self.region_px = np.argsort(labels, kind='stable').astype(np.int32)
+        counts = np.bincount(labels + 1, minlength=len(self.stars) + 1)[1:]
+        self.region_start = np.concatenate([[0], np.cumsum(counts)]) + (labels < 0).sum()
+        # Drawn stars to repaint with each star, its own and those lying in
+        # its territory
+        self.region_stars = [[] for _ in self.stars]
+        for j, (i, label) in enumerate(zip(drawn.tolist(),
+                                           self.labels[self.star_px].tolist())):
+            self.region_stars[i].append(j)
+            if label >= 0 and label != i:
+                self.region_stars[label].append(j)
+
+        # Canvas of palette indices, one per percieved pixel, rows first
+        dtype = np.uint8 if len(self.palette) <= 256 else np.uint16
+        self.canvas = np.full(self.labels.shape, len(self.cols) - 2, dtype)
+        self.draw()
 
     # Coordinate conversion
     # Percieved pixels to np coordinates
@@ -84,59 +137,91 @@ class Map:
         return x, y
 
     # Image processing
-    # Draw a percieved pixel
+    # Full size RGB frame, percieved pixels expanded only here
+    def frame(self):
+        frame = self.palette[self.canvas]
+        return frame.repeat(self.rescale, axis=0).repeat(self.rescale, axis=1)
+
+    @property
+    def image(self):
+        if self.canvas.dtype != np.uint8:
+            return PIL.Image.fromarray(self.frame())
+        image = PIL.Image.fromarray(self.canvas, 'P')
+        image.putpalette(self.palette.ravel().tolist())
+        return image.resize(self.im_size, PIL.Image.NEAREST)
+
+    # Draw a percieved pixel with a palette index
     def draw_px(self, x, y, c):
-        self.draw.rectangle([x * self.rescale, y * self.rescale,
-                             (x + 1) * self.rescale - 1, (y + 1) * self.rescale - 1],
-                            c, c)
+        self.canvas[y, x] = c
 
     # Draw percieved pixels for stars
     def draw_stars(self):
-        for star in self.stars.values():
-            x, y = self.map_to_img(star.x, star.y)
-            self.draw_px(x, y, self.star_cols[self.owners[star.id]])
+        owners = self.owners[self.star_drawn] % len(self.star_cols)
+        self.canvas[self.star_px] = len(self.cols) + owners
+
+    # Percieved pixels of a grid cell
+    def cell_slice(self, cx, cy):
+        return (slice(cy * self.pix_per_cell, (cy + 1) * self.pix_per_cell),
+                slice(cx * self.pix_per_cell, (cx + 1) * self.pix_per_cell))
+
+    # Nearest star of each percieved pixel in a grid cell
+    def cell_labels(self, cx, cy):
+        near = [i for ncx in range(cx - 1, cx + 2)
+                for ncy in range(cy - 1, cy + 2)
+                for i in self.grid[ncx][ncy]]
+        ys, xs = (np.arange(s.start, s.stop) for s in self.cell_slice(cx, cy))
+        mx, my = self.img_to_map(xs[None, :], ys[:, None])
+        nearest = nearest_stars(mx, my, self.star_x[near], self.star_y[near],
+                                self.max_dist, self.border)
+        return np.array(near + [-1], int)[nearest]
+
+    # Redraw the whole map
+    def draw(self):
+        owners = np.append(self.owners, -2) % len(self.cols)
+        self.canvas[:] = owners[self.labels]
+        self.draw_stars()
 
     # Redraw a grid cell
     def update_cell(self, cx, cy):
-        for x in range(cx * self.pix_per_cell, (cx + 1) * self.pix_per_cell):
-            for y in range(cy * self.pix_per_cell, (cy + 1) * self.pix_per_cell):
-                mx, my = self.img_to_map(x, y)
-                min_dist = self.max_dist
-                nearest = -2
-                for ncx in range(cx - 1, cx + 2):
-                    for ncy in range(cy - 1, cy + 2):
-                        for star in self.grid[ncx][ncy]:
-                            l = sqrt((mx - star.x)**2 + (my - star.y)**2)
-                            if abs(min_dist - l) <= self.border:
-                                nearest = -2
-                            if l < min_dist:
-                                if abs(min_dist - l) > self.border:
-                                    nearest = self.owners[star.id]
-                                min_dist = l
-                self.draw_px(x, y, self.cols[nearest])
+        # Owner of every star and -2 for no star at all
+        owners = np.append(self.owners, -2) % len(self.cols)
+        cell = self.cell_slice(cx, cy)
+        self.canvas[cell] = owners[self.labels[cell]]
 
+    # Repaint only the territories and star pixels of stars that changed owner
     def update(self, owners):
-        update_grid = []
-        for x in range(self.grid_size[0]):
-            update_grid.append([False] * self.grid_size[1])
-        
+        changed = set()
         for owner in owners:
-            star = self.stars[owner.star_id]
-            if self.owners[star.id] != owner.player:
-                cx, cy = self.map_to_cell(star.x, star.y)
-                # Mark each possibly affected grid cell
-                for x in range(cx - 1, cx + 2):
-                    for y in range(cy - 1, cy + 2):
-                        update_grid[x][y] = True
-                self.owners[star.id] = owner.player
-
-        # Redraw every possibly affected cell
-        for x in range(self.grid_size[0] - 1):
-            for y in range(self.grid_size[1] - 1):
-                if update_grid[x][y]:
-                    self.update_cell(x, y)
-
-        self.draw_stars()
+            i = self.star_index[owner.star_id]
+            if self.owners[i] != owner.player:
+                self.owners[i] = owner.player
+                changed.add(i)
+
+        canvas = self.canvas.reshape(-1)
+        stars = set()
+        for i in changed:
+            region = self.region_px[self.region_start[i]:self.region_start[i + 1]]
+            canvas[region] = self.owners[i] % len(self.cols)
+            self.dirty_pixels += len(region)
+            stars.update(self.region_stars[i])
+
+        # Stars are drawn over territories
+        for j in stars:
+            i = self.star_drawn[j]
+            self.canvas[self.star_px[0][j], self.star_px[1][j]] = \
+                len(self.cols) + self.owners[i] % len(self.star_cols)
+
+    # Replace the owners of all stars, given by star index
+    def set_owners(self, owners):
+        self.owners[:] = owners
+        self.draw()
+
+    # Frames after applying each tick's owners in turn
+    def frames(self, ticks):
+        for owners in ticks:
+            if owners:
+                self.update(owners)
+            yield self.frame()
 
     def save(self, path):
         self.image.save(path)
@@ -0,0 +1,106 @@
+from flask import current_app
+
+from contextlib import contextmanager
+from datetime import datetime
+import fcntl
+import json
+import logging
+import os
+import os.path
+import re
+import time
+
+
+# Log of timelapse jobs and the timing records of their stages, both in the
+# instance folder
+LOG_FILE = 'vid_gen.log'
+TIMING_FILE = 'timings.jsonl'
+
+logger = logging.getLogger('nptimelapse.metrics')
+
+
+def init_logging(app):
+    tasks = logging.getLogger('nptimelapse.tasks')
+    if tasks.handlers:
+        return
+    handler = logging.FileHandler(os.path.join(app.instance_path, LOG_FILE), delay=True)
+    handler.setFormatter(logging.Formatter('%(asctime)s|%(levelname)s| %(message)s'))
+    tasks.addHandler(handler)
+    tasks.setLevel(logging.INFO)
+    handler = logging.FileHandler(os.path.join(app.instance_path, TIMING_FILE), delay=True)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+
+# Time a stage of work. The yielded record takes extra fields like counts of
+# stars, ticks or redrawn cells and is emitted when the stage ends.
+@contextmanager
+def span(name, **fields):
+    record = dict(fields)
+    start = time.perf_counter()
+    try:
+        yield record
+    except BaseException:
+        record['failed'] = True
+        raise
+    finally:
+        record['seconds'] = time.perf_counter() - start
+        emit(name, record)
+
+
+# Add the time spent in a block to a field of a record, for work repeated
+# inside a span like drawing every frame
+@contextmanager
+def timed(record, field):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record[field] = record.get(field, 0) + time.perf_counter() - start
+
+
+# Add up numeric fields of another record, for example from render processes
+def merge(record, other):
+    for field, value in other.items():
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            record[field] = record.get(field, 0) + value
+
+
+def emit(name, record):
+    logger.info(json.dumps({'span': name, 'time': datetime.now().isoformat(), **record}))
+    path = current_app.config.get('METRICS_FILE')
+    if path:
+        update_metrics(path, name, record)
+
+
+# Prometheus text format counters, added up over all spans ever emitted
+SAMPLE = re.compile(r'^(\w+)\{span="(\w+)"\} (\S+)$')
+
+
+# Add a span to the metrics file, which other processes may update too
+def update_metrics(path, name, record):
+    with open(f'{path}.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        samples = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    match = SAMPLE.match(line)
+                    if match:
+                        samples[match[1], match[2]] = float(match[3])
+        increments = {'nptimelapse_span_total': 1}
+        for field, value in record.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                increments[f'nptimelapse_span_{field}_total'] = value
+        for metric, value in increments.items():
+            samples[metric, name] = samples.get((metric, name), 0) + value
+        # Written aside and moved so the collector never reads a partial file
+        with open(f'{path}.tmp', 'w') as f:
+            for metric in sorted({metric for metric, _ in samples}):
+                f.write(f'# TYPE {metric} counter\n')
+                for (other, span_name), value in sorted(samples.items()):
+                    if other == metric:
+                        f.write(f'{metric}{{span="{span_name}"}} {value}\n')
+        os.replace(f'{path}.tmp', path)
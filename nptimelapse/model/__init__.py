@@ -1,3 +1,5 @@
+from sqlalchemy import insert
+
 from nptimelapse.extensions import db
 
 
@@ -7,6 +9,9 @@ class Game(db.Model):
     api_key = db.Column('api_key', db.String(6), nullable=False)
     name = db.Column('name', db.String(40), nullable=False)
     close_date = db.Column('close_date', db.DateTime())
+    # First and last tick with recorded owners, kept up to date on insert
+    start_tick = db.Column('start_tick', db.Integer())
+    end_tick = db.Column('end_tick', db.Integer())
     stars = db.relationship('Star')
     owners = db.relationship('Owner')
 
@@ -34,6 +39,116 @@ class Owner(db.Model):
             ['star_id', 'game_id'],
             ['star.id', 'star.game_id'],
         ),
+        # Serve latest owner lookups and per game tick ranges
+        db.Index('ix_owner_game_star_tick', 'game_id', 'star_id', 'tick'),
+        db.Index('ix_owner_game_tick', 'game_id', 'tick'),
     )
     game = db.relationship('Game', back_populates='owners', overlaps='owners')
     star = db.relationship('Star', back_populates='owners', overlaps='game,owners')
+
+
+# Latest row of Owner for every star, kept in sync with it on every insert
+class CurrentOwner(db.Model):
+    __tablename__ = 'current_owner'
+    star_id = db.Column('star_id', db.Integer(), primary_key=True)
+    game_id = db.Column('game_id', db.BigInteger(), db.ForeignKey('game.id'),
+                        primary_key=True)
+    tick = db.Column('tick', db.Integer(), nullable=False)
+    player = db.Column('player', db.SmallInteger(), nullable=False)
+    __table_args__ = (
+        db.ForeignKeyConstraint(
+            ['star_id', 'game_id'],
+            ['star.id', 'star.game_id'],
+        ),
+    )
+
+
+# Keyframe of the owners of all stars of a game, packed by nptimelapse.snapshots
+class Snapshot(db.Model):
+    __tablename__ = 'snapshot'
+    game_id = db.Column('game_id', db.BigInteger(), db.ForeignKey('game.id'),
+                        primary_key=True)
+    tick = db.Column('tick', db.Integer(), primary_key=True)
+    owners = db.Column('owners', db.LargeBinary(), nullable=False)
+
+
+# Whole history of a closed game packed by nptimelapse.compaction, replacing
+# its owner rows and keyframes
+class PackedHistory(db.Model):
+    __tablename__ = 'packed_history'
+    game_id = db.Column('game_id', db.BigInteger(), db.ForeignKey('game.id'),
+                        primary_key=True)
+    history = db.Column('history', db.LargeBinary(), nullable=False)
+
+
+# Timelapse rendered into the video cache, named by its key
+class Video(db.Model):
+    __tablename__ = 'video'
+    key = db.Column('key', db.String(64), primary_key=True)
+    variant = db.Column('variant', db.String(64), nullable=False, index=True)
+    game_id = db.Column('game_id', db.BigInteger(), nullable=False)
+    last_tick = db.Column('last_tick', db.Integer(), nullable=False)
+    name = db.Column('name', db.String(80), nullable=False)  # Download file name
+    format = db.Column('format', db.String(8), nullable=False, default='mp4')
+    size = db.Column('size', db.BigInteger(), nullable=False)
+    created = db.Column('created', db.DateTime(), nullable=False)
+    last_access = db.Column('last_access', db.DateTime(), nullable=False)
+
+
+# Render job of a video. Its row locks the video to one task and carries the
+# progress the task reports; updated doubles as the job's heartbeat. A failed
+# job keeps its row, holding off new renders until retry_after.
+class Job(db.Model):
+    __tablename__ = 'job'
+    key = db.Column('key', db.String(64), primary_key=True)
+    task_id = db.Column('task_id', db.String(64), nullable=False)
+    phase = db.Column('phase', db.String(16), nullable=False)
+    first_tick = db.Column('first_tick', db.Integer())
+    tick = db.Column('tick', db.Integer())  # Last rendered tick
+    last_tick = db.Column('last_tick', db.Integer())
+    eta = db.Column('eta', db.Float())  # Seconds left as of the last update
+    updated = db.Column('updated', db.DateTime(), nullable=False)
+    error = db.Column('error', db.String(64))  # Exception type of a failed job
+    retry_after = db.Column('retry_after', db.DateTime())
+
+
+# Widen the recorded tick range of a game to include a tick
+def record_tick(game, tick):
+    if game.start_tick is None or tick < game.start_tick:
+        game.start_tick = tick
+    if game.end_tick is None or tick > game.end_tick:
+        game.end_tick = tick
+
+
+# Store owners, given as dicts of Owner columns in tick order, keeping only
+# those that change the current owner of their star. Stars start unowned.
+# Returns the stored owners.
+def record_owners(owners):
+    current = {(game_id, star_id): player for game_id, star_id, player in
+               db.session.query(CurrentOwner.game_id, CurrentOwner.star_id, CurrentOwner.player)
+               .filter(CurrentOwner.game_id.in_({owner['game_id'] for owner in owners}))}
+    changes = []
+    for owner in owners:
+        key = (owner['game_id'], owner['star_id'])
+        if current.get(key, -1) != owner['player']:
+            current[key] = owner['player']
+            changes.append(owner)
+    if changes:
+        db.session.execute(insert(Owner), changes)
+        # Only the last change of each star is current
+        record_current_owners(list({(owner['game_id'], owner['star_id']): owner
+                                    for owner in changes}.values()))
+    return changes
+
+
+# Keep the current owner snapshot in sync with newly added owners, given as
+# dicts of Owner columns
+def record_current_owners(owners):
+    keys = [(owner['game_id'], owner['star_id']) for owner in owners]
+    known = {(game_id, star_id) for game_id, star_id in
+             db.session.query(CurrentOwner.game_id, CurrentOwner.star_id)
+             .filter(CurrentOwner.game_id.in_({game_id for game_id, _ in keys}))}
+    db.session.bulk_update_mappings(
+        CurrentOwner, [owner for owner, key in zip(owners, keys) if key in known])
+    db.session.bulk_insert_mappings(
+        CurrentOwner, [owner for owner, key in zip(owners, keys) if key not in known])
@@ -0,0 +1,73 @@
+from flask import current_app
+from sqlalchemy import func
+
+from nptimelapse.extensions import db
+from nptimelapse.history import History
+from nptimelapse.model import Owner, Snapshot, PackedHistory
+
+import numpy as np
+
+
+# Default number of ticks between keyframes of a game
+SNAPSHOT_INTERVAL = 24
+
+
+def snapshot_interval():
+    return current_app.config.get('SNAPSHOT_INTERVAL', SNAPSHOT_INTERVAL)
+
+
+# Owners by star id packed as int32 star ids followed by int8 players
+def pack(owners):
+    star_ids = np.array(list(owners), '<i4')
+    players = np.array(list(owners.values()), '<i1')
+    return star_ids.tobytes() + players.tobytes()
+
+
+def unpack(data):
+    count = len(data) // 5
+    star_ids = np.frombuffer(data, '<i4', count)
+    players = np.frombuffer(data, '<i1', count, count * 4)
+    return dict(zip(star_ids.tolist(), players.tolist()))
+
+
+# Last keyframe tick of every game that has one
+def last_snapshots():
+    return dict(db.session.query(Snapshot.game_id, func.max(Snapshot.tick))
+                .group_by(Snapshot.game_id).all())
+
+
+def record_snapshot(game_id, tick, owners):
+    db.session.merge(Snapshot(game_id=game_id, tick=tick, owners=pack(owners)))
+
+
+# Owners of all stars of a game after a tick, from the nearest keyframe and
+# the changes recorded since, or from the packed history of the game
+def owners_at(game_id, tick):
+    history = History.from_packed(game_id)
+    if history is not None:
+        return dict(zip(history.star_ids.tolist(), history.owners_at(tick).tolist()))
+    snapshot = Snapshot.query.filter(Snapshot.game_id == game_id) \
+        .filter(Snapshot.tick <= tick).order_by(Snapshot.tick.desc()).first()
+    changes = db.session.query(Owner.star_id, Owner.player) \
+        .filter(Owner.game_id == game_id).filter(Owner.tick <= tick)
+    if snapshot is None:
+        owners = {}
+    else:
+        owners = unpack(snapshot.owners)
+        changes = changes.filter(Owner.tick > snapshot.tick)
+    owners.update(changes.order_by(Owner.tick).all())
+    return owners
+
+
+# Replace all keyframes of a game with ones rebuilt from its history. Packed
+# games need none.
+def build_snapshots(game_id):
+    Snapshot.query.filter(Snapshot.game_id == game_id).delete()
+    if db.session.get(PackedHistory, game_id) is not None:
+        return
+    history = History.from_db(game_id)
+    interval = snapshot_interval()
+    star_ids = history.star_ids.tolist()
+    for tick in range(history.first_tick, history.last_tick + 1, interval):
+        owners = history.owners_at(tick).tolist()
+        record_snapshot(game_id, tick, dict(zip(star_ids, owners)))
@@ -0,0 +1,328 @@
+// Paints timelapse frames in the browser from the label map and the history
+// served by the API, see nptimelapse/api.py and nptimelapse/history.py for
+// the binary layouts. Changing the star style only repaints, other options
+// load another label map.
+
+function mod(a, n) {
+    return ((a % n) + n) % n;
+}
+
+function magic(buffer) {
+    return String.fromCharCode(...new Uint8Array(buffer, 0, 4));
+}
+
+function parseHistory(buffer) {
+    if (magic(buffer) !== 'NPTH') {
+        throw new Error('Not a game history');
+    }
+    const view = new DataView(buffer);
+    const stars = view.getUint32(6, true);
+    const changes = view.getUint32(10, true);
+    // Star ids and coordinates are not needed to paint
+    let offset = 22 + stars * 20;
+    const ticks = new Int32Array(buffer.slice(offset, offset + changes * 4));
+    offset += changes * 4;
+    const starIndices = new Uint16Array(buffer.slice(offset, offset + changes * 2));
+    offset += changes * 2;
+    return {
+        stars: stars,
+        firstTick: view.getInt32(14, true),
+        lastTick: view.getInt32(18, true),
+        ticks: ticks,
+        starIndices: starIndices,
+        players: new Int8Array(buffer.slice(offset, offset + changes)),
+    };
+}
+
+function parseLabels(buffer) {
+    if (magic(buffer) !== 'NPTL') {
+        throw new Error('Not a label map');
+    }
+    const view = new DataView(buffer);
+    const width = view.getUint32(8, true);
+    const height = view.getUint32(12, true);
+    const stars = view.getUint32(16, true);
+    const drawn = view.getUint32(20, true);
+    const labelSize = view.getUint16(24, true);
+    const colors = view.getUint16(26, true);
+    let offset = 28;
+    const take = (Type, count, size) => {
+        const array = new Type(buffer.slice(offset, offset + count * size));
+        offset += count * size;
+        return array;
+    };
+    const labels = take(labelSize === 2 ? Int16Array : Int32Array, width * height, labelSize);
+    const starDrawn = take(Int32Array, drawn, 4);
+    const starX = take(Int32Array, drawn, 4);
+    const starY = take(Int32Array, drawn, 4);
+    const palette = take(Uint8Array, colors * 3, 1);
+    const cols = [];
+    for (let i = 0; i < colors; i++) {
+        cols.push([palette[i * 3], palette[i * 3 + 1], palette[i * 3 + 2]]);
+    }
+    return {
+        rescale: view.getUint16(6, true),
+        width: width,
+        height: height,
+        stars: stars,
+        labels: labels,
+        starDrawn: starDrawn,
+        starPixels: Array.from(starY, (y, j) => y * width + starX[j]),
+        cols: cols,
+    };
+}
+
+// Star colors of a star style, like index.draw_options picks them
+function starColors(style, cols) {
+    if (style === 'white') {
+        return [[255, 255, 255]];
+    }
+    if (style === 'black') {
+        return [[0, 0, 0]];
+    }
+    if (style === 'contrast') {
+        return cols.map(c => c[0] * .299 + c[1] * .587 + c[2] * .114 > 128
+                             ? [0, 0, 0] : [255, 255, 255]);
+    }
+    return cols;
+}
+
+class Painter {
+    constructor(canvas, history, labels, starStyle) {
+        this.canvas = canvas;
+        this.history = history;
+        this.map = labels;
+        this.starCols = starColors(starStyle, labels.cols);
+        canvas.width = labels.width;
+        canvas.height = labels.height;
+        this.context = canvas.getContext('2d');
+        this.image = this.context.createImageData(labels.width, labels.height);
+        this.owners = new Int16Array(history.stars).fill(-1);
+        this.next = 0;  // First change not applied yet
+        this.tick = history.firstTick - 1;
+
+        // Pixels of each star's territory, those of star i being
+        // pixels[start[i]:start[i + 1]]
+        const start = new Int32Array(labels.stars + 1);
+        labels.labels.forEach(label => {
+            if (label >= 0) {
+                start[label + 1]++;
+            }
+        });
+        for (let i = 0; i < labels.stars; i++) {
+            start[i + 1] += start[i];
+        }
+        const fill = start.slice(0, labels.stars);
+        this.pixels = new Int32Array(start[labels.stars]);
+        labels.labels.forEach((label, pixel) => {
+            if (label >= 0) {
+                this.pixels[fill[label]++] = pixel;
+            }
+        });
+        this.start = start;
+    }
+
+    setPixel(pixel, color) {
+        const data = this.image.data;
+        data[pixel * 4] = color[0];
+        data[pixel * 4 + 1] = color[1];
+        data[pixel * 4 + 2] = color[2];
+        data[pixel * 4 + 3] = 255;
+    }
+
+    territoryColor(star) {
+        const cols = this.map.cols;
+        return cols[mod(star < 0 ? -2 : this.owners[star], cols.length)];
+    }
+
+    paintAll() {
+        this.map.labels.forEach((label, pixel) => this.setPixel(pixel, this.territoryColor(label)));
+        this.paintStars();
+    }
+
+    paintTerritory(star) {
+        const color = this.territoryColor(star);
+        for (let p = this.start[star]; p < this.start[star + 1]; p++) {
+            this.setPixel(this.pixels[p], color);
+        }
+    }
+
+    paintStars() {
+        this.map.starDrawn.forEach((star, j) => {
+            const color = this.starCols[mod(this.owners[star], this.starCols.length)];
+            this.setPixel(this.map.starPixels[j], color);
+        });
+    }
+
+    setStarStyle(style) {
+        this.starCols = starColors(style, this.map.cols);
+        this.paintStars();
+        this.context.putImageData(this.image, 0, 0);
+    }
+
+    // Show the map after all changes up to a tick, replaying from the start
+    // when going back
+    seek(tick) {
+        const history = this.history;
+        let full = this.tick < history.firstTick;
+        if (tick < this.tick) {
+            this.owners.fill(-1);
+            this.next = 0;
+            full = true;
+        }
+        const changed = new Set();
+        while (this.next < history.ticks.length && history.ticks[this.next] <= tick) {
+            const star = history.starIndices[this.next];
+            this.owners[star] = history.players[this.next];
+            changed.add(star);
+            this.next++;
+        }
+        this.tick = tick;
+        if (full || changed.size > history.stars / 4) {
+            this.paintAll();
+        } else {
+            changed.forEach(star => this.paintTerritory(star));
+            this.paintStars();
+        }
+        this.context.putImageData(this.image, 0, 0);
+    }
+}
+
+function loadBuffer(url) {
+    return fetch(url).then(response => {
+        if (!response.ok) {
+            throw new Error(`${url}: ${response.status}`);
+        }
+        return response.arrayBuffer();
+    });
+}
+
+const FPS = 24;
+
+// Attributes: historyUrl, labelsUrl, requestUrl, star, border, smoothness
+const Viewer = {
+    oninit(vnode) {
+        const attrs = vnode.attrs;
+        this.options = {star: attrs.star, border: attrs.border, rescale: attrs.smoothness - 1};
+        this.painter = null;
+        this.tick = null;
+        this.timer = null;
+        this.error = null;
+        this.history = loadBuffer(attrs.historyUrl).then(parseHistory);
+    },
+
+    // Fetch the label map of the current options and repaint
+    load(attrs) {
+        const params = new URLSearchParams({border: this.options.border,
+                                            rescale: this.options.rescale});
+        Promise.all([this.history, loadBuffer(`${attrs.labelsUrl}?${params}`)])
+            .then(([history, buffer]) => {
+                this.painter = new Painter(this.canvas, history, parseLabels(buffer),
+                                           this.options.star);
+                if (this.tick === null) {
+                    this.tick = history.lastTick;
+                }
+                this.painter.seek(this.tick);
+            })
+            .catch(error => {
+                this.error = error.message;
+            })
+            .finally(m.redraw);
+    },
+
+    seek(tick) {
+        this.tick = tick;
+        this.painter.seek(tick);
+    },
+
+    play() {
+        if (this.timer !== null) {
+            clearInterval(this.timer);
+            this.timer = null;
+            return;
+        }
+        const history = this.painter.history;
+        if (this.tick >= history.lastTick) {
+            this.seek(history.firstTick);
+        }
+        this.timer = setInterval(() => {
+            if (this.tick >= history.lastTick) {
+                clearInterval(this.timer);
+                this.timer = null;
+            } else {
+                this.seek(this.tick + 1);
+            }
+            m.redraw();
+        }, 1000 / FPS);
+    },
+
+    onremove() {
+        clearInterval(this.timer);
+    },
+
+    choice(name, label, values, attrs) {
+        return [
+            label,
+            m('.uk-margin.uk-grid-small.uk-child-width-auto[uk-grid]', values.map(value =>
+                m('label', [
+                    m('input.uk-radio[type=radio]', {
+                        name: name,
+                        value: value,
+                        checked: this.options[name] === value,
+                        onchange: () => {
+                            this.options[name] = value;
+                            if (name === 'star') {
+                                this.painter && this.painter.setStarStyle(value);
+                            } else {
+                                this.load(attrs);
+                            }
+                        },
+                    }),
+                    ' ', value.charAt(0).toUpperCase() + value.slice(1),
+                ])
+            )),
+        ];
+    },
+
+    view(vnode) {
+        const attrs = vnode.attrs;
+        const history = this.painter && this.painter.history;
+        return [
+            m('canvas', {
+                style: 'width: 100%; image-rendering: pixelated',
+                oncreate: canvas => {
+                    this.canvas = canvas.dom;
+                    this.load(attrs);
+                },
+            }),
+            this.error ? m('.uk-text-danger', this.error) : null,
+            history ? [
+                m('input.uk-range[type=range]', {
+                    min: history.firstTick,
+                    max: history.lastTick,
+                    value: this.tick,
+                    oninput: event => this.seek(Number(event.target.value)),
+                }),
+                m('.uk-margin.uk-flex.uk-flex-between.uk-flex-middle', [
+                    m('button.uk-button.uk-button-default', {onclick: () => this.play()},
+                      this.timer === null ? 'Play' : 'Pause'),
+                    m('span', `Tick ${this.tick}`),
+                ]),
+            ] : m('div', 'Loading...'),
+            this.choice('star', 'Star style:', ['none', 'white', 'black', 'contrast'], attrs),
+            this.choice('border', 'Border style:', ['none', 'organic'], attrs),
+            'Smoothness:',
+            m('.uk-margin', m('input.uk-range[type=range]', {
+                min: -1, max: 4, step: 1,
+                value: this.options.rescale,
+                onchange: event => {
+                    this.options.rescale = Number(event.target.value);
+                    this.load(attrs);
+                },
+            })),
+            m('a.uk-button.uk-button-primary.uk-width-1-1', {
+                href: `${attrs.requestUrl}?${new URLSearchParams(this.options)}`,
+            }, 'Request video download'),
+        ];
+    },
+};
@@ -1,18 +1,30 @@
 from flask import current_app
-from sqlalchemy import func
 
-from nptimelapse.extensions import celery, db
+from nptimelapse.encoding import DEFAULT_PROFILE, profile_settings, profile_format, \
+                                 video_writer
+from nptimelapse.extensions import celery
+from nptimelapse.fetch import np2stats_game, np2stats_history
+from nptimelapse.history import History
 from nptimelapse.map_maker import Map
-from nptimelapse.model import Game, Star, Owner
+from nptimelapse.metrics import span, timed, merge
+from nptimelapse.model import Game
+from nptimelapse.video_cache import store, video_variant, video_path, previous_video, \
+                                    job_owner, job_workspace, claim_job, release_job, \
+                                    fail_job, report_phase, report_progress
 
 import logging
 import os
 import os.path
-import glob
 from math import sqrt
-import moviepy.editor as mpy
-import requests
-import shutil
+from billiard import Pool
+from moviepy.config import get_setting
+import subprocess
+from uuid import uuid4
+
+
+SEGMENT_TICKS = 24  # Fewest ticks rendered as one segment in parallel mode
+
+logger = logging.getLogger(__name__)
 
 
 # Errors
@@ -24,34 +36,52 @@ class TimelapseGameNotRegisteredError(TimelapseError):
         self.game_id = game_id
         super().__init__(self, f'Game {game_id} is not registered')
 
-class TimelapseTmpFolderExistsError(TimelapseError):
-    def __init__(self, path):
-        self.path = path
-        super().__init__(self, f'tmp folder already exists at {path}')
 
+@celery.task(bind=True)
+def make_timelapse(self, source_id, key, map_config={}, game_params={}, last_tick=None,
+                   profile=DEFAULT_PROFILE):
+    logger.info(f'Generate timelapse {source_id}')
+
+    # Work in the job's own folder, claimed here unless the request did
+    task_id = self.request.id or uuid4().hex
+    if job_owner(key) != task_id and not claim_job(key, task_id):
+        logger.info(f'Timelapse {key} is already being generated')
+        return
+    try:
+        with span('timelapse', source_id=source_id, key=key):
+            report_phase(key, 'loading')
+            workspace = job_workspace(key)
+            render_timelapse(source_id, key, workspace, map_config, game_params, last_tick,
+                             profile)
+    except Exception as e:
+        # Kept as failed so open request pages don't queue it again at once
+        logger.error(f'Timelapse {key} failed: {e!r}')
+        with span('cleanup', key=key):
+            fail_job(key, e)
+        raise
+    except BaseException:
+        # Interrupted, for example by a worker shutdown
+        with span('cleanup', key=key):
+            release_job(key)
+        raise
+    with span('cleanup', key=key):
+        release_job(key)
 
-@celery.task
-def make_timelapse(source_id, tl_path, map_config={}, game_params={}):
-    logging.basicConfig(format='%(asctime)s|%(levelname)s| %(message)s',
-                        filename=os.path.join(current_app.instance_path, 'vid_gen.log'),
-                        level=logging.INFO)
-    logging.info(f'Generate timelapse {source_id}')
-    
-    # Make sure the video cache exists
-    video_cache = os.path.join(current_app.instance_path, 'video_cache')
-    if not os.path.exists(video_cache):
-        os.mkdir(video_cache)
 
+# Render a timelapse in a claimed workspace and store it in the video cache
+def render_timelapse(source_id, key, workspace, map_config, game_params, last_tick,
+                     profile=DEFAULT_PROFILE):
     # Get basic game info
     if source_id.isnumeric():
-        game_data = db.session.query(func.min(Owner.tick), func.max(Owner.tick), Game) \
-            .filter(Game.id == int(source_id)).join(Game.owners).group_by(Game.id).one_or_none()
-        if game_data is None:
-            logging.error(f'Attempt to generate unregistered game {source_id}')
+        game = Game.query.filter(Game.id == int(source_id)) \
+            .filter(Game.start_tick != None).one_or_none()
+        if game is None:
+            logger.error(f'Attempt to generate unregistered game {source_id}')
             raise TimelapseGameNotRegisteredError(source_id)
-        start_tick, end_tick, game = game_data
+        start_tick, end_tick = game.start_tick, game.end_tick
+        game_id, name = game.id, game.name
     elif source_id == 'external':
-        payload = requests.get('https://np2stats.dysp.info/api/timelapsedata.php').json()
+        payload = np2stats_history({})
         start_tick = min(min(int(tick) for tick in star['owners']) for star in payload['stars'].values())
         start_tick = 9
         end_tick = max(max(int(tick) for tick in star['owners']) for star in payload['stars'].values())
@@ -65,58 +95,153 @@ def make_timelapse(source_id, tl_path, map_config={}, game_params={}):
             raise Exception(f'Invalid request: no player ID!')
         if 'key' not in game_params:
             raise Exception(f'Invalid request: no authentication key provided!')
-        payload = requests.get('https://np2stats.dysp.info/api/timelapsedata.php', params=game_params).json()
-        start_tick = min(min(int(tick) for tick in star['owners']) for star in payload['stars'].values())
-        end_tick = max(max(int(tick) for tick in star['owners']) for star in payload['stars'].values())
+        # Usually already fetched by the web process for the request page
+        payload = np2stats_history(game_params)
+        summary = np2stats_game(game_params)
+        start_tick, end_tick = summary['start_tick'], summary['end_tick']
+        game_id, name = summary['id'], summary['name']
     else:
-        logging.error(f'Attempt to generate a game from an unrecognised id {source_id}')
+        logger.error(f'Attempt to generate a game from an unrecognised id {source_id}')
         raise TimelapseGameNotRegisteredError(source_id)
-    tl_path = os.path.join(video_cache, f'{tl_path}')
-
-    # Check for tmp folder to see if the timelapse is not being created by another worker
-    tmp_folder = os.path.join(video_cache, f'tmp')
-    if os.path.exists(tmp_folder):
-        logging.error('tmp folder exists. Abort generation.')
-        raise TimelapseTmpFolderExistsError(tmp_folder)
-    os.mkdir(tmp_folder)
+    # Render only what the requested key describes
+    if last_tick is not None:
+        end_tick = min(end_tick, last_tick)
 
     # Prepare the map
-    logging.info('Generation start...')
-    if source_id.isnumeric():
-        stars = Star.query.filter(Star.game_id == int(source_id)).all()
-    elif source_id == 'np2stats':
-        stars = [Star(game_id=int(payload['id']), id=int(s_id), x=s['x'], y=s['y'])
-                 for s_id, s in payload['stars'].items()]
-    m = Map(stars, **map_config)
-
-    # Generate images
-    for tick in range(start_tick, end_tick + 1):
-        if tick % 24 == 0:
-            logging.info(f'Generating tick {tick}')
+    logger.info('Generation start...')
+    report_phase(key, 'loading', first_tick=start_tick, last_tick=end_tick)
+    with span('load', source_id=source_id, key=key) as record:
         if source_id.isnumeric():
-            owners = Owner.query.filter(Owner.game_id == int(source_id)) \
-            .filter(Owner.tick == tick).all()
+            history = History.from_db(int(source_id))
         elif source_id == 'np2stats':
-            owners = [Owner(tick=tick, player=int(star['owners'][str(tick)]), star_id=int(star_id), game_id=int(payload['id']))
-                      for star_id, star in payload['stars'].items()
-                      if str(tick) in star['owners']]
-        if owners:
-            m.update(owners)
-        m.save(os.path.join(tmp_folder, f'{tick:04}.png'))
-
-    # Make a video
-    logging.info('Rendering video')
-    images = glob.glob(os.path.join(tmp_folder, '*.png'))
-    images.sort()
-    video = mpy.ImageSequenceClip(images, fps=24)
-    video.write_videofile(os.path.join(tmp_folder, 'vid.mp4'))
-    shutil.move(os.path.join(tmp_folder, 'vid.mp4'), tl_path)
-    
-    # Cleanup the tmp_folder
-    logging.info('Cleanup')
-    for image in images:
-        os.remove(image)
-    os.rmdir(tmp_folder)
-    logging.info('Generation successfull')
-
-    return
+            history = History.from_np2stats(payload)
+        record.update(stars=len(history.star_ids), changes=len(history.ticks))
+    with span('map', key=key, stars=len(history.star_ids)) as record:
+        m = Map(history.star_points(), **map_config)
+        record.update(cells=(m.grid_size[0] - 1) * (m.grid_size[1] - 1),
+                      pixels=m.im_size[0] * m.im_size[1])
+
+    # Extend the longest cached video of the same variant if there is one
+    variant = video_variant(source_id, game_id, map_config, game_params, profile)
+    settings = profile_settings(profile)
+    video_format = profile_format(settings)
+    extension = video_format['extension']
+    video = os.path.join(workspace, f'vid.{extension}')
+    base = previous_video(variant, end_tick) if video_format['joinable'] else None
+    if base is not None and start_tick <= base.last_tick:
+        logger.info(f'Extending video {base.key} from tick {base.last_tick}')
+        m.set_owners(history.owners_at(base.last_tick))
+        tail = os.path.join(workspace, f'tail.{extension}')
+        render_ticks(tail, m, history, base.last_tick + 1, end_tick, key, settings)
+        report_phase(key, 'joining')
+        with span('concat', key=key, videos=2):
+            concat_videos([video_path(base.key, base.format), tail], video)
+        os.remove(tail)
+    else:
+        render_ticks(video, m, history, start_tick, end_tick, key, settings)
+    report_phase(key, 'storing')
+    with span('store', key=key):
+        store(key, variant, video, game_id, end_tick,
+              f'{name.replace(" ", "_")}_{game_id}.{extension}', settings.get('format', 'mp4'))
+    logger.info('Generation successfull')
+
+
+# Stream frames of a range of ticks straight into the encoder
+def render_ticks(video, m, history, start_tick, end_tick, key, profile):
+    logger.info(f'Rendering ticks {start_tick} to {end_tick}')
+    report_phase(key, 'rendering', start_tick - 1)
+    processes = current_app.config.get('TIMELAPSE_PROCESSES', 1)
+    # Only formats that can be joined are rendered in segments
+    if not profile_format(profile)['joinable']:
+        processes = 1
+    with span('render', key=key, stars=len(m.stars), ticks=end_tick - start_tick + 1,
+              processes=processes) as record:
+        if processes > 1 and end_tick > start_tick:
+            render_parallel(video, m, history, start_tick, end_tick, processes, key,
+                            profile, record)
+            return
+        writer = video_writer(video, m, profile)
+        ticks = history.tick_owners(start_tick, end_tick)
+        for tick, _ in enumerate(write_frames(writer, m, ticks, record), start_tick):
+            if tick % 24 == 0:
+                logger.info(f'Generating tick {tick}')
+            report_progress(key, tick)
+
+
+# Encode a frame after applying each tick's owners, yielding after every tick.
+# Time spent updating the map, expanding frames and encoding them is added
+# to the record along with the number of repainted pixels.
+def write_frames(writer, m, ticks, record):
+    pixels = m.dirty_pixels
+    for owners in ticks:
+        with timed(record, 'update_seconds'):
+            if owners:
+                m.update(owners)
+        with timed(record, 'frame_seconds'):
+            frame = m.frame()
+        with timed(record, 'encode_seconds'):
+            writer.write_frame(frame)
+        yield
+    with timed(record, 'encode_seconds'):
+        writer.close()
+    record['dirty_pixels'] = record.get('dirty_pixels', 0) + m.dirty_pixels - pixels
+
+
+# Render chunks of ticks into separate segments on a pool of processes and
+# join them without re-encoding
+def render_parallel(video, m, history, start_tick, end_tick, processes, key, profile,
+                    record):
+    size = max(SEGMENT_TICKS, -(-(end_tick - start_tick + 1) // (processes * 4)))
+    extension = profile_format(profile)['extension']
+    chunks = [(os.path.join(os.path.dirname(video), f'segment_{start:06}.{extension}'),
+               start, min(start + size - 1, end_tick))
+              for start in range(start_tick, end_tick + 1, size)]
+    logger.info(f'Rendering {len(chunks)} segments on {processes} processes')
+    record['segments'] = len(chunks)
+    done = 0
+    with Pool(processes, init_segment_process, (m, history, profile)) as pool:
+        for segment in pool.imap_unordered(render_segment, chunks):
+            done += segment.pop('ticks')
+            merge(record, segment)
+            report_progress(key, start_tick + done - 1)
+    report_phase(key, 'joining')
+    with span('concat', key=key, videos=len(chunks)):
+        concat_videos([path for path, _, _ in chunks], video)
+    for path, _, _ in chunks:
+        os.remove(path)
+
+
+# Map, history and encoding profile shared by the chunks a render process
+# works on
+segment_job = {}
+
+
+def init_segment_process(m, history, profile):
+    segment_job['map'] = m
+    segment_job['history'] = history
+    segment_job['profile'] = profile
+
+
+def render_segment(chunk):
+    path, start_tick, end_tick = chunk
+    m, history = segment_job['map'], segment_job['history']
+    # Owners as they were right before the chunk, replayed from the history
+    record = {'ticks': end_tick - start_tick + 1}
+    with timed(record, 'update_seconds'):
+        m.set_owners(history.owners_at(start_tick - 1))
+    writer = video_writer(path, m, segment_job['profile'])
+    for _ in write_frames(writer, m, history.tick_owners(start_tick, end_tick), record):
+        pass
+    return record
+
+
+# Join videos encoded with the same settings by stream copy
+def concat_videos(paths, output):
+    playlist = output + '.txt'
+    with open(playlist, 'w') as f:
+        for path in paths:
+            f.write(f"file '{os.path.abspath(path)}'\n")
+    subprocess.run([get_setting('FFMPEG_BINARY'), '-y', '-loglevel', 'error',
+                    '-f', 'concat', '-safe', '0', '-i', playlist, '-c', 'copy', output],
+                   check=True)
+    os.remove(playlist)
@@ -0,0 +1,291 @@
+from flask import current_app
+from sqlalchemy.exc import IntegrityError
+
+from nptimelapse.encoding import DEFAULT_PROFILE, FORMATS, PROFILES, profile_settings
+from nptimelapse.extensions import db
+from nptimelapse.model import Video, Job
+
+from datetime import datetime, timedelta
+import hashlib
+import json
+import os
+import os.path
+import shutil
+import time
+
+
+# Default disk budget of the video cache in bytes
+VIDEO_CACHE_SIZE = 2 * 1024**3
+# Seconds without a heartbeat after which a render job is considered dead
+JOB_TIMEOUT = 3600
+# Fewest seconds between progress writes of a render job
+PROGRESS_INTERVAL = 1
+# Default seconds before a failed render job can be queued again on its own
+JOB_RETRY_DELAY = 600
+
+
+def cache_folder():
+    video_cache = os.path.join(current_app.instance_path, 'video_cache')
+    if not os.path.exists(video_cache):
+        os.mkdir(video_cache)
+    return video_cache
+
+
+# Hash of everything that affects a video's content except its length. Videos
+# of the same variant only differ by how many ticks they show. Videos of the
+# default profile keep the hashes they had before profiles existed, as long
+# as its settings are the built-in ones.
+def video_variant(source_id, game_id, map_config, game_params={}, profile=DEFAULT_PROFILE):
+    inputs = {'source_id': source_id,
+                'game_id': int(game_id),
+             'map_config': map_config,
+              'player_id': game_params.get('player_id')}
+    settings = profile_settings(profile)
+    if profile != DEFAULT_PROFILE or settings != PROFILES[DEFAULT_PROFILE]:
+        inputs['profile'] = {'name': profile, **settings}
+    inputs = json.dumps(inputs, sort_keys=True)
+    return hashlib.sha256(inputs.encode()).hexdigest()
+
+
+# Key of a video of a variant ending at a tick
+def video_key(variant, last_tick):
+    return hashlib.sha256(f'{variant}:{int(last_tick)}'.encode()).hexdigest()
+
+
+def video_path(key, video_format='mp4'):
+    return os.path.join(cache_folder(), f'{key}.{FORMATS[video_format]["extension"]}')
+
+
+# Cached video for a key, marked as just used. The mark is only written
+# once a minute so that range requests of one download don't each commit.
+def lookup(key):
+    video = Video.query.filter(Video.key == key).one_or_none()
+    if video is None:
+        return None
+    if not os.path.exists(video_path(key, video.format)):
+        db.session.delete(video)
+        db.session.commit()
+        return None
+    now = datetime.now()
+    if (now - video.last_access).total_seconds() >= 60:
+        video.last_access = now
+        db.session.commit()
+    return video
+
+
+# Longest cached video of a variant ending before a tick, for extending
+def previous_video(variant, last_tick):
+    videos = Video.query.filter(Video.variant == variant) \
+        .filter(Video.last_tick < last_tick).order_by(Video.last_tick.desc())
+    for video in videos:
+        if os.path.exists(video_path(video.key, video.format)):
+            return video
+    return None
+
+
+# Move a rendered video into the cache, replacing shorter videos of its
+# variant, and make room for it
+def store(key, variant, path, game_id, last_tick, name, video_format='mp4'):
+    shutil.move(path, video_path(key, video_format))
+    now = datetime.now()
+    db.session.merge(Video(key=key, variant=variant, game_id=int(game_id),
+                           last_tick=int(last_tick), name=name, format=video_format,
+                           size=os.path.getsize(video_path(key, video_format)),
+                           created=now, last_access=now))
+    for video in Video.query.filter(Video.variant == variant) \
+                            .filter(Video.last_tick < last_tick):
+        remove(video)
+    db.session.commit()
+    evict(keep=key)
+
+
+# Remove least recently used videos until the cache fits its budget. The
+# video of key is kept even if it alone is over budget, so it can be served
+# at least until the next video is stored.
+def evict(budget=None, keep=None):
+    clean_jobs()
+    if budget is None:
+        budget = current_app.config.get('VIDEO_CACHE_SIZE', VIDEO_CACHE_SIZE)
+    videos = Video.query.order_by(Video.last_access.desc()).all()
+    total = sum(video.size for video in videos if video.key == keep)
+    for video in videos:
+        if video.key == keep:
+            continue
+        total += video.size
+        if total > budget:
+            remove(video)
+    db.session.commit()
+
+
+def remove(video):
+    if os.path.exists(video_path(video.key, video.format)):
+        os.remove(video_path(video.key, video.format))
+    db.session.delete(video)
+
+
+# Render jobs are locked and tracked by a row of the job table, so their
+# state can be read without touching the worker's disk. The task owning a job
+# works in its own folder under video_cache/jobs named by the video key.
+def jobs_folder():
+    jobs = os.path.join(cache_folder(), 'jobs')
+    if not os.path.exists(jobs):
+        os.mkdir(jobs)
+    return jobs
+
+
+def job_folder(key):
+    return os.path.join(jobs_folder(), key)
+
+
+# Empty workspace for the task owning a job, dropping leftovers of dead jobs
+def job_workspace(key):
+    folder = job_folder(key)
+    shutil.rmtree(folder, ignore_errors=True)
+    os.mkdir(folder)
+    return folder
+
+
+# Failed jobs stay alive until they may be retried
+def job_alive(job):
+    if job.phase == 'failed':
+        return datetime.now() < job.retry_after
+    timeout = current_app.config.get('TIMELAPSE_JOB_TIMEOUT', JOB_TIMEOUT)
+    return (datetime.now() - job.updated).total_seconds() < timeout
+
+
+def job_running(key):
+    job = Job.query.filter(Job.key == key).one_or_none()
+    return job is not None and job_alive(job)
+
+
+# Task that owns a job
+def job_owner(key):
+    job = Job.query.filter(Job.key == key).one_or_none()
+    return None if job is None else job.task_id
+
+
+# Claim a job for a task, replacing a dead one. Returns False if a live job
+# already has it.
+def claim_job(key, task_id):
+    job = Job.query.filter(Job.key == key).one_or_none()
+    if job is not None:
+        if job_alive(job):
+            return False
+        # Only the claimer that still sees the dead row gets to replace it
+        if not Job.query.filter(Job.key == key, Job.updated == job.updated).delete():
+            db.session.rollback()
+            return False
+    db.session.add(Job(key=key, task_id=task_id, phase='queued', updated=datetime.now()))
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return False
+    return True
+
+
+# Give up a claim whose task could not be queued
+def unclaim_job(key, task_id):
+    db.session.rollback()
+    Job.query.filter(Job.key == key, Job.task_id == task_id).delete()
+    db.session.commit()
+
+
+# Start and end of the running phase of the jobs of this process, for ETAs
+phases = {}
+
+
+# Move a job to a new phase, optionally setting the ticks it covers and the
+# tick it starts from
+def report_phase(key, phase, tick=None, first_tick=None, last_tick=None):
+    values = {'phase': phase, 'eta': None, 'updated': datetime.now()}
+    if tick is not None:
+        values['tick'] = tick
+    if first_tick is not None:
+        values['first_tick'] = first_tick
+    if last_tick is not None:
+        values['last_tick'] = last_tick
+    Job.query.filter(Job.key == key).update(values, synchronize_session=False)
+    db.session.commit()
+    job = phases.get(key, {})
+    phases[key] = {'began': time.time(), 'tick': tick,
+                   'last_tick': values.get('last_tick', job.get('last_tick')),
+                   'reported': time.time()}
+
+
+# Record the last rendered tick of a job, doubling as its heartbeat. Writes
+# are spaced out by PROGRESS_INTERVAL except for the last tick.
+def report_progress(key, tick):
+    phase = phases[key]
+    now = time.time()
+    if now - phase['reported'] < PROGRESS_INTERVAL and tick != phase['last_tick']:
+        return
+    values = {'tick': tick, 'updated': datetime.now()}
+    if phase['tick'] is not None and phase['last_tick'] is not None and tick > phase['tick']:
+        rate = (now - phase['began']) / (tick - phase['tick'])
+        values['eta'] = rate * (phase['last_tick'] - tick)
+    Job.query.filter(Job.key == key).update(values, synchronize_session=False)
+    db.session.commit()
+    phase['reported'] = now
+
+
+# Phase, rendered and total ticks and seconds left of a live job, or the
+# error of a failed one and seconds until it is retried
+def job_status(key):
+    job = Job.query.filter(Job.key == key).one_or_none()
+    if job is None or not job_alive(job):
+        return None
+    if job.phase == 'failed':
+        return {'phase': 'failed', 'error': job.error,
+                'retry_in': round((job.retry_after - datetime.now()).total_seconds())}
+    status = {'phase': job.phase, 'progress': 0, 'total': None, 'eta': None}
+    if job.first_tick is not None and job.last_tick is not None:
+        status['total'] = job.last_tick - job.first_tick + 1
+        if job.tick is not None:
+            status['progress'] = job.tick - job.first_tick + 1
+    if job.eta is not None:
+        since = (datetime.now() - job.updated).total_seconds()
+        status['eta'] = max(0, round(job.eta - since))
+    return status
+
+
+def release_job(key):
+    phases.pop(key, None)
+    Job.query.filter(Job.key == key).delete(synchronize_session=False)
+    db.session.commit()
+    shutil.rmtree(job_folder(key), ignore_errors=True)
+
+
+# Keep the row of a failed job so it isn't queued again before the retry
+# delay passes, unless asked to by retry_job
+def fail_job(key, error):
+    db.session.rollback()
+    phases.pop(key, None)
+    delay = current_app.config.get('TIMELAPSE_RETRY_DELAY', JOB_RETRY_DELAY)
+    now = datetime.now()
+    Job.query.filter(Job.key == key).update(
+        {'phase': 'failed', 'error': type(error).__name__[:64], 'eta': None,
+         'updated': now, 'retry_after': now + timedelta(seconds=delay)},
+        synchronize_session=False)
+    db.session.commit()
+    shutil.rmtree(job_folder(key), ignore_errors=True)
+
+
+# Drop a failed job so it can be claimed again right away
+def retry_job(key):
+    Job.query.filter(Job.key == key, Job.phase == 'failed').delete()
+    db.session.commit()
+
+
+# Remove rows and workspaces of dead jobs
+def clean_jobs():
+    live = set()
+    for job in Job.query.all():
+        if job_alive(job):
+            live.add(job.key)
+        else:
+            db.session.delete(job)
+    db.session.commit()
+    for key in os.listdir(jobs_folder()):
+        if key not in live:
+            shutil.rmtree(job_folder(key), ignore_errors=True)
@@ -5,3 +5,5 @@ SQLALCHEMY_DATABASE_URI = 'sqlite:////{instance}/nptimelapse.sqlite3'
 
 CELERY_BROKER_URL = 'amqp://localhost'
 CELERY_IGNORE_RESULT = True
+
+VIDEO_CACHE_SIZE = 2 * 1024**3